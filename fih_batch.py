@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""
+Score FITS frames without a display.
+
+Runs the focuser on every frame found in the given files, directories
+or glob patterns and writes one line per frame, as CSV or JSON, in the
+order the frames were given. Frames are processed in a process pool.
+"""
+
+import csv
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from optparse import OptionParser
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import numpy as np
+from focuser import Focuser
+from fih_fits import FitsData
+from fih_metrics import MetricsStore
+from fih_pixels import to_gray
+
+FIELDS = ("file", "stars", "hfr", "sharpness", "roundness1", "roundness2",
+          "background", "noise", "width", "height", "bayer", "seconds",
+          "error")
+
+
+def is_fit(name: str) -> bool:
+    return os.path.splitext(name)[1].lower() in (".fit", ".fits", ".fts")
+
+
+def find_files(args: List[str]) -> Iterator[str]:
+    for arg in args:
+        if os.path.isdir(arg):
+            names = sorted(
+                f for f in os.listdir(arg)
+                if is_fit(f) and os.path.isfile(os.path.join(arg, f)))
+            for f in names:
+                yield os.path.join(arg, f)
+        elif os.path.isfile(arg):
+            yield arg
+        else:
+            yield from sorted(glob.glob(arg))
+
+
+def score(filename: str, param: Dict[str, Any]
+          ) -> Tuple[Dict[str, Any], Optional[Dict[str, np.ndarray]]]:
+    """Summary row of one frame and the arrays to store with it."""
+    t = time.perf_counter()
+    row: Dict[str, Any] = {"file": filename}
+    arrays = None
+    try:
+        fits = FitsData(filename, param["display/mmap"])
+        bayer = fits.header.get("BAYERPAT", "NONE")
+        data = to_gray(fits.read(), bayer)
+        focuser = Focuser(
+            algo=param["focuser/finder"],
+            n_stars=param["focuser/n_stars"],
+            fwhm=param["focuser/fwhm"],
+            threshold_stds=param["focuser/threshold"],
+            background=param["focuser/background"])
+        focuser.evaluate(data)
+        if param["hfr"] and focuser.num() > 0:
+            focuser.hfr(data)
+        row.update(focuser.summary())
+        row.update(width=fits.width, height=fits.height, bayer=bayer)
+        arrays = focuser.arrays()
+    except Exception as e:
+        row["error"] = str(e)
+    row["seconds"] = time.perf_counter() - t
+    return (row, arrays)
+
+
+def cached(store: Optional[MetricsStore], filename: str,
+           param: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    if store is None:
+        return None
+    hit = store.get(filename, param, arrays=False)
+    if hit is None:
+        return None
+    summary = hit[0]
+    if param["hfr"] and summary["stars"] > 0 and "hfr" not in summary:
+        return None
+    return dict({"file": filename}, **summary, seconds=0.0)
+
+
+class CsvWriter:
+
+    def __init__(self, out):
+        self.w = csv.DictWriter(out, FIELDS, restval="")
+        self.w.writeheader()
+
+    def write(self, row: Dict[str, Any]):
+        self.w.writerow({
+            k: ("%.6g" % v if isinstance(v, float) else v)
+            for k, v in row.items()})
+
+
+class JsonWriter:
+
+    def __init__(self, out):
+        self.out = out
+
+    def write(self, row: Dict[str, Any]):
+        self.out.write(json.dumps(row) + "\n")
+
+
+def main():
+    parser = OptionParser(
+        usage="usage: %prog [opts] file|dir|glob...")
+    parser.add_option("--format", type="choice", choices=("csv", "json"),
+                      default="csv", help="Output csv or json lines")
+    parser.add_option("--output", type="string", default="",
+                      help="Write to this file instead of stdout")
+    parser.add_option("--workers", type="int", default=os.cpu_count(),
+                      help="Number of worker processes")
+    parser.add_option("--finder", type="choice", choices=("dao", "iraf"),
+                      default="dao", help="Star finder")
+    parser.add_option("--n_stars", type="int", default=100,
+                      help="Brightest stars to measure")
+    parser.add_option("--fwhm", type="float", default=3.0,
+                      help="Expected star FWHM in pixels")
+    parser.add_option("--threshold", type="float", default=3.0,
+                      help="Detection threshold in background stds")
+    parser.add_option("--background", type="choice",
+                      choices=("exact", "fast", "mesh"), default="exact",
+                      help="Background estimation, see the Focuser menu")
+    parser.add_option("--no_hfr", action="store_false", dest="hfr",
+                      default=True, help="Skip the half flux radius")
+    parser.add_option("--no_mmap", action="store_false", dest="mmap",
+                      default=True, help="Do not memory map the files")
+    parser.add_option("--metrics", type="string", default="",
+                      help="Metrics database, shared with the viewer")
+    parser.add_option("--no_metrics", action="store_false",
+                      dest="use_metrics", default=True,
+                      help="Always recompute, do not store the results")
+    (opts, args) = parser.parse_args()
+    if not args:
+        parser.error("no input given")
+    # Same keys as the viewer parameters, see fih_metrics.METRIC_PARAMS.
+    param = {
+        "focuser/finder": opts.finder,
+        "focuser/n_stars": opts.n_stars,
+        "focuser/fwhm": opts.fwhm,
+        "focuser/threshold": opts.threshold,
+        "focuser/background": opts.background,
+        "display/lab": False,
+        "display/mmap": opts.mmap,
+        "hfr": opts.hfr,
+    }
+    store = MetricsStore(opts.metrics) if opts.use_metrics else None
+    out = open(opts.output, "w", newline="") if opts.output else sys.stdout
+    writer = CsvWriter(out) if opts.format == "csv" else JsonWriter(out)
+    files = list(find_files(args))
+    with ProcessPoolExecutor(max(1, opts.workers)) as pool:
+        # Rows are written in input order, cached ones as soon as all
+        # the frames before them are done.
+        jobs = []
+        for f in files:
+            row = cached(store, f, param)
+            if row is None:
+                jobs.append((f, pool.submit(score, f, param)))
+            else:
+                jobs.append((f, row))
+        for f, job in jobs:
+            if isinstance(job, dict):
+                row = job
+            else:
+                row, arrays = job.result()
+                if store is not None and arrays is not None:
+                    summary = {k: v for k, v in row.items()
+                               if k not in ("file", "seconds")}
+                    store.put(f, param, summary, arrays)
+            writer.write(row)
+            out.flush()
+    if store is not None:
+        store.close()
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == "__main__":
+    main()
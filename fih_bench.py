@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the image and focuser hot paths on synthetic star fields.
+
+Each benchmark prints one JSON object per line, so that runs can be
+saved and compared. The "pipeline" benchmark times the steps a frame
+goes through in the viewer, on a mono and a Bayer frame, without Gtk.
+"""
+
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from optparse import OptionParser
+import cv2
+import numpy as np
+from astropy.io import fits
+from astropy.stats import sigma_clipped_stats
+from focuser import Focuser, batch_hfr
+from fih_fits import FitsData
+from fih_pixels import (
+    BAYER_CONV, apply_lut, stretch_lut, superpixel_debayer, to_gray)
+from fih_stats import Quantiles, clipped_stats
+
+# Relative response of the red, green and blue pixels of a Bayer frame.
+BAYER_GAIN = {"R": 0.8, "G": 1.0, "B": 0.6}
+
+
+def star_field(height, width, n_stars, fwhm, seed=0, background=1000.,
+               noise=10., peak=5000.):
+    """uint16 frame with Gaussian stars, and the true star positions."""
+    rng = np.random.default_rng(seed)
+    img = rng.normal(background, noise, (height, width))
+    xs = rng.uniform(0, width - 1, n_stars)
+    ys = rng.uniform(0, height - 1, n_stars)
+    sigma = fwhm / 2.3548 * rng.uniform(0.7, 1.5, n_stars)
+    half = int(np.ceil(4 * sigma.max()))
+    off = np.arange(-half, half + 1)
+    for x, y, s in zip(xs, ys, sigma):
+        r = np.clip(int(y) + off, 0, height - 1)
+        c = np.clip(int(x) + off, 0, width - 1)
+        r = r[np.r_[True, np.diff(r) > 0]]
+        c = c[np.r_[True, np.diff(c) > 0]]
+        img[np.ix_(r, c)] += peak * np.exp(
+            -((r[:, None] - y) ** 2 + (c[None, :] - x) ** 2) / (2 * s * s))
+    return np.clip(img, 0, 65535).astype(np.uint16), xs, ys
+
+
+def bayer_field(img, pattern):
+    """Mosaic a mono frame with the channel gains of a Bayer sensor."""
+    out = img.astype(np.float64)
+    for p, c in enumerate(pattern[:4]):
+        out[p // 2::2, p % 2::2] *= BAYER_GAIN[c]
+    return out.astype(img.dtype)
+
+
+def timed(fn, *args):
+    t = time.perf_counter()
+    ret = fn(*args)
+    return ret, time.perf_counter() - t
+
+
+def measured(fn, *args, repeat=1):
+    """Result, best time of repeat runs and peak traced memory of fn.
+
+    Memory is measured on an extra run, as tracing slows allocations.
+    numpy and the arrays OpenCV returns are traced, OpenCV scratch
+    buffers are not.
+    """
+    best = None
+    for _ in range(repeat):
+        ret, t = timed(fn, *args)
+        best = t if best is None else min(best, t)
+    del ret
+    tracemalloc.start()
+    ret = fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return ret, best, peak
+
+
+def fit_size(width, height, viewport):
+    scale = max(width / viewport[0], height / viewport[1])
+    return (int(width / scale), int(height / scale))
+
+
+def bench_hfr(opts):
+    img, xs, ys = star_field(
+        opts.height, opts.width, opts.stars, opts.fwhm, opts.seed)
+    focuser = Focuser(fwhm=opts.fwhm)
+    ref, t_ref = timed(
+        lambda: np.array([focuser.star_hfr(img, x, y)
+                          for x, y in zip(xs, ys)]))
+    fast, t_fast = timed(batch_hfr, img, xs, ys, opts.fwhm)
+    err = np.abs(fast - ref)
+    print(json.dumps({
+        "bench": "hfr",
+        "stars": opts.stars,
+        "bisect_s": t_ref,
+        "batch_s": t_fast,
+        "speedup": t_ref / t_fast,
+        "max_abs_err": float(err.max()),
+        "mean_abs_err": float(err.mean()),
+    }))
+
+
+def bench_background(opts):
+    img, _, _ = star_field(
+        opts.height, opts.width, opts.stars, opts.fwhm, opts.seed)
+    (_, ref_median, ref_std), t_ref = timed(
+        lambda: sigma_clipped_stats(img, sigma=3.0, maxiters=5))
+    (_, median, std), t_fast = timed(clipped_stats, img)
+    print(json.dumps({
+        "bench": "background",
+        "exact_s": t_ref,
+        "fast_s": t_fast,
+        "speedup": t_ref / t_fast,
+        "median_err": float(median - ref_median),
+        "std_rel_err": float((std - ref_std) / ref_std),
+    }))
+
+
+def bench_pipeline(opts):
+    mono, _, _ = star_field(
+        opts.height, opts.width, opts.stars, opts.fwhm, opts.seed)
+    frames = (("mono", mono, "NONE"),
+              ("bayer", bayer_field(mono, opts.bayer), opts.bayer))
+    del mono
+    viewport = tuple(int(v) for v in opts.viewport.split("x"))
+    size = fit_size(opts.width, opts.height, viewport)
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind, img, bayer in frames:
+            filename = os.path.join(tmp, kind + ".fit")
+            header = fits.Header()
+            if bayer != "NONE":
+                header["BAYERPAT"] = bayer
+            fits.PrimaryHDU(img, header=header).writeto(filename)
+            pipeline(opts, kind, filename, bayer, size)
+
+
+def pipeline(opts, kind, filename, bayer, size):
+    def step(stage, fn, *args, pixels=opts.width * opts.height, stars=0):
+        ret, seconds, peak = measured(fn, *args, repeat=opts.repeat)
+        out = {
+            "bench": "pipeline",
+            "frame": kind,
+            "stage": stage,
+            "width": opts.width,
+            "height": opts.height,
+            "seconds": seconds,
+            "peak_mb": peak / (1 << 20),
+        }
+        if stars:
+            out["stars_s"] = stars / seconds
+        else:
+            out["mpix_s"] = pixels / seconds / 1e6
+        print(json.dumps(out))
+        return ret
+
+    raw = step("load", lambda: FitsData(filename, opts.mmap).read())
+    if bayer != "NONE":
+        code = BAYER_CONV[bayer][0]
+        # As Image.preview_size(), only when zoomed out at least 2x.
+        if opts.width >= 2 * size[0]:
+            step("preview", superpixel_debayer, raw, code, size[0],
+                 size[1])
+        color = step("debayer", cv2.cvtColor, raw, code)
+        gray = step("gray", to_gray, color)
+    else:
+        color = raw
+        gray = raw
+    small = step("scale", cv2.resize, color, size, None, 0, 0,
+                 cv2.INTER_AREA)
+    want = [0.5, 99.5]
+    (cmin, cmax) = step(
+        "histogram", lambda: Quantiles(gray).percentile(want))
+    lut = stretch_lut(16, float(cmin), float(cmax), 0.0, False)
+    step("stretch", apply_lut, small, lut,
+         pixels=small.shape[0] * small.shape[1])
+    focuser = Focuser(algo=opts.finder, n_stars=opts.stars,
+                      fwhm=opts.fwhm, background=opts.background)
+    sources = step("evaluate", focuser.evaluate, gray)
+    if sources is None:
+        return
+    step("hfr", batch_hfr, gray, sources["xcentroid"],
+         sources["ycentroid"], opts.fwhm, stars=len(sources))
+
+
+BENCHES = {
+    "hfr": bench_hfr,
+    "background": bench_background,
+    "pipeline": bench_pipeline,
+}
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [opts] [bench...]")
+    parser.add_option("--width", type="int", default=4656,
+                      help="Frame width")
+    parser.add_option("--height", type="int", default=3520,
+                      help="Frame height")
+    parser.add_option("--stars", type="int", default=1000,
+                      help="Number of synthetic stars")
+    parser.add_option("--fwhm", type="float", default=3.0,
+                      help="Star FWHM in pixels")
+    parser.add_option("--seed", type="int", default=0,
+                      help="Random seed")
+    parser.add_option("--bayer", type="string", default="RGGB",
+                      help="Bayer pattern of the color frame")
+    parser.add_option("--viewport", type="string", default="1280x960",
+                      help="Window size the frame is scaled to")
+    parser.add_option("--finder", type="choice", choices=("dao", "iraf"),
+                      default="dao", help="Star finder")
+    parser.add_option("--background", type="choice",
+                      choices=("exact", "fast", "mesh"), default="exact",
+                      help="Focuser background estimation")
+    parser.add_option("--repeat", type="int", default=1,
+                      help="Report the best of this many runs")
+    parser.add_option("--no_mmap", action="store_false", dest="mmap",
+                      default=True, help="Do not memory map the files")
+    (opts, args) = parser.parse_args()
+    for name in args or BENCHES:
+        BENCHES[name](opts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+
+class LRUCache:
+    """Thread safe LRU cache bounded by the total size of its values.
+
+    If max_items is not zero, the number of entries is bounded too.
+    """
+
+    def __init__(self, budget: int, sizeof: Callable[[Any], int],
+                 max_items: int = 0):
+        self.budget = budget
+        self.max_items = max_items
+        self.sizeof = sizeof
+        self.size = 0
+        self.items: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.sizes: Dict[Hashable, int] = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self.lock:
+            return key in self.items
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.items)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            try:
+                self.items.move_to_end(key)
+            except KeyError:
+                return default
+            return self.items[key]
+
+    def put(self, key: Hashable, value: Any):
+        size = self.sizeof(value)
+        with self.lock:
+            self.drop(key)
+            if size > self.budget:
+                return
+            self.items[key] = value
+            self.sizes[key] = size
+            self.size += size
+            self.evict()
+
+    def resize(self, key: Hashable):
+        """Measure the value of key again, once it grew or shrank."""
+        with self.lock:
+            if key not in self.items:
+                return
+            size = self.sizeof(self.items[key])
+            self.size += size - self.sizes[key]
+            self.sizes[key] = size
+            if size > self.budget:
+                self.drop(key)
+            self.evict()
+
+    def set_budget(self, budget: int, max_items: Optional[int] = None):
+        with self.lock:
+            self.budget = budget
+            if max_items is not None:
+                self.max_items = max_items
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.sizes.clear()
+            self.size = 0
+
+    def drop(self, key: Hashable):
+        if key in self.items:
+            del self.items[key]
+            self.size -= self.sizes.pop(key)
+
+    def evict(self):
+        while self.items and (
+                self.size > self.budget or
+                0 < self.max_items < len(self.items)):
+            self.drop(next(iter(self.items)))
+
+
+class Prefetcher:
+    """Background thread filling a cache with the wanted keys, in order.
+
+    load is called from the prefetch thread and returns the value to
+    cache, or None if the key cannot be loaded. Exceptions it raises
+    are printed and the key skipped.
+    """
+
+    def __init__(
+            self, cache: LRUCache, load: Callable[[Hashable], Optional[Any]]):
+        self.cache = cache
+        self.load = load
+        self.wanted: List[Hashable] = []
+        self.cond = threading.Condition()
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def want(self, keys: List[Hashable]):
+        with self.cond:
+            self.wanted = list(keys)
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.wanted:
+                    self.cond.wait()
+                key = self.wanted.pop(0)
+            if key in self.cache:
+                continue
+            try:
+                value = self.load(key)
+            except Exception as e:
+                # A bad file must not stop prefetching the next ones.
+                print("Cannot prefetch %s: %s" % (key, e))
+                continue
+            if value is not None:
+                self.cache.put(key, value)
@@ -1,11 +1,25 @@
 
+import os
+import threading
+import time
+from collections import deque
 import gi
+import numpy as np
 import pyasicam.pyasicam as pc
 from fih_image import Image
+from fih_pixels import brightest_star, to_gray
+from fih_lucky import LuckySelector
+from fih_stack import MAX_WINDOW, LiveStack
+from fih_timing import StageTimer
+from fih_writer import FitsWriter, SerWriter
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk, GLib
 
 
+# Capture errors in a row after which the camera is stopped.
+MAX_FAILURES = 8
+
+
 class ZwoDialog(Gtk.Dialog):
 
     def __init__(self, parent, cams):
@@ -100,6 +114,31 @@ class ControlsDialog(Gtk.Dialog):
         self.cam_grid.attach(self.cam_bin, 1, row, 1, 1)
         row += 1
 
+        self.cam_prefix = Gtk.Entry()
+        self.cam_grid.attach(Gtk.Label("Save prefix:"), 0, row, 1, 1)
+        self.cam_grid.attach(self.cam_prefix, 1, row, 1, 1)
+        row += 1
+
+        self.cam_stack_frames = Gtk.Entry()
+        self.cam_grid.attach(Gtk.Label("Stack frames:"), 0, row, 1, 1)
+        self.cam_grid.attach(self.cam_stack_frames, 1, row, 1, 1)
+        row += 1
+
+        self.cam_stack_sigma = Gtk.Entry()
+        self.cam_grid.attach(Gtk.Label("Stack sigma:"), 0, row, 1, 1)
+        self.cam_grid.attach(self.cam_stack_sigma, 1, row, 1, 1)
+        row += 1
+
+        self.cam_lucky_keep = Gtk.Entry()
+        self.cam_grid.attach(Gtk.Label("Lucky keep (%):"), 0, row, 1, 1)
+        self.cam_grid.attach(self.cam_lucky_keep, 1, row, 1, 1)
+        row += 1
+
+        self.cam_lucky_batch = Gtk.Entry()
+        self.cam_grid.attach(Gtk.Label("Lucky batch:"), 0, row, 1, 1)
+        self.cam_grid.attach(self.cam_lucky_batch, 1, row, 1, 1)
+        row += 1
+
         apply_button = Gtk.Button.new_with_label("Apply")
         apply_button.connect("clicked", self.apply_controls)
         self.cam_grid.attach(apply_button, 0, row, 2, 1)
@@ -126,9 +165,21 @@ class ControlsDialog(Gtk.Dialog):
         self.cam_cooler.set_active(self.parent.param["cam/cooler"])
         self.cam_temp.set_text(str(self.parent.param["cam/temp"]))
         self.cam_bin.set_text(str(self.parent.param["cam/bin"]))
+        self.cam_prefix.set_text(self.parent.param["cam/prefix"])
+        self.cam_stack_frames.set_text(
+            str(self.parent.param["cam/stack_frames"]))
+        self.cam_stack_sigma.set_text(
+            str(self.parent.param["cam/stack_sigma"]))
+        self.cam_lucky_keep.set_text(
+            str(self.parent.param["cam/lucky_keep"]))
+        self.cam_lucky_batch.set_text(
+            str(self.parent.param["cam/lucky_batch"]))
 
     def apply_controls(self, w):
         try:
+            frames = int(self.cam_stack_frames.get_text())
+            if not 0 < frames <= MAX_WINDOW:
+                raise ValueError("stack frames %d" % frames)
             row = self.cam_mode.get_selected_row()
             idx = row.get_index()
             self.parent.param["cam/mode"] = idx
@@ -141,6 +192,15 @@ class ControlsDialog(Gtk.Dialog):
             self.parent.param["cam/cooler"] = self.cam_cooler.get_active()
             self.parent.param["cam/temp"] = int(self.cam_temp.get_text())
             self.parent.param["cam/bin"] = int(self.cam_bin.get_text())
+            self.parent.param["cam/prefix"] = os.path.expanduser(
+                self.cam_prefix.get_text())
+            self.parent.param["cam/stack_frames"] = frames
+            self.parent.param["cam/stack_sigma"] = float(
+                self.cam_stack_sigma.get_text())
+            self.parent.param["cam/lucky_keep"] = float(
+                self.cam_lucky_keep.get_text())
+            self.parent.param["cam/lucky_batch"] = int(
+                self.cam_lucky_batch.get_text())
             self.cam.new_par = True
         except ValueError:
             self.update_controls()
@@ -150,6 +210,43 @@ class ControlsDialog(Gtk.Dialog):
         return True
 
 
+class FrameQueue:
+    """Bounded queue of frames dropping the oldest one when full.
+
+    on_drop is called with every frame that is never taken.
+    """
+
+    def __init__(self, maxlen, on_drop):
+        self.frames = deque()
+        self.maxlen = maxlen
+        self.on_drop = on_drop
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def put(self, frame):
+        with self.lock:
+            self.frames.append(frame)
+            old = []
+            while len(self.frames) > self.maxlen:
+                old.append(self.frames.popleft())
+            self.dropped += len(old)
+        for f in old:
+            self.on_drop(f)
+
+    def newest(self):
+        """Take the newest frame, dropping the older ones."""
+        with self.lock:
+            if not self.frames:
+                return None
+            frame = self.frames.pop()
+            old = list(self.frames)
+            self.frames.clear()
+            self.dropped += len(old)
+        for f in old:
+            self.on_drop(f)
+        return frame
+
+
 class Cam:
 
     def __init__(self, parent):
@@ -158,7 +255,8 @@ class Cam:
         self.typ = parent.param["cam/type"]
         if self.typ == "zwo":
             pc.GetNumOfConnectedCameras()
-            self.c = pc.Camera(int(parent.param["cam/id"]))
+            self.c = pc.Camera(
+                int(parent.param["cam/id"]), buffers=self.pool_size())
             self.prop = self.c.GetCameraProperty()
             self.is_color = self.prop.IsColorCam == 1
             self.name = self.prop.Name.decode()
@@ -174,69 +272,348 @@ class Cam:
         self.new_par = False
         self.controls_dialog = None
         self.image = None
+        self.thread = None
+        self.acquiring = False
+        self.video = False
+        self.lock = threading.Lock()
+        self.queue = FrameQueue(
+            parent.param["cam/queue"],
+            lambda frame: self.parent.timings.add(frame[1]))
+        self.show_pending = False
+        self.stack = LiveStack(
+            pc.BufferPool(parent.param["cam/queue"] + 2))
+        self.lucky = LuckySelector(pc.BufferPool())
+        self.writer = None
+        self.recorder = None
+        self.frames = 0
+        self.rate_start = time.monotonic()
+        self.fps = 0.0
+        self.dropped = 0
+        # Start of the frames read, in binned sensor pixels.
+        self.origin = (0, 0)
+
+    def pool_size(self):
+        """Camera buffers needed for every frame that can be in use."""
+        p = self.parent.param
+        # Queued frames, the one drawn and the one being read.
+        count = p["cam/queue"] + 2
+        # Frames waiting for the writers and the ones being written.
+        if p["cam/save"]:
+            count += p["cam/save_queue"] + p["cam/save_batch"]
+        if p["cam/record"]:
+            count += p["cam/record_queue"] + SerWriter.BATCH
+        return count
 
     def close(self):
         if self.typ == "zwo":
             self.c.CloseCamera()
 
     def start(self):
+        if self.typ != "zwo" or self.thread is not None:
+            return
         self.update()
-        if self.typ == "zwo":
+        self.video = self.parent.param["cam/video"]
+        if self.video:
+            self.c.StartVideoCapture()
+            self.parent.set_status("Streaming")
+            target = self.run_video
+        else:
             self.parent.set_status("Exposing")
-            self.c.StartExposure(0)
+            target = self.run_snapshot
         self.parent.param["cam/run"] = True
-        GLib.timeout_add(100, self.poll)
+        self.acquiring = True
+        self.thread = threading.Thread(target=target)
+        self.thread.daemon = True
+        self.thread.start()
 
     def stop(self):
-        if not self.parent.param["cam/run"]:
-            return
         self.parent.param["cam/run"] = False
-        if self.typ == "zwo":
-            self.parent.set_status("Stopped")
-            self.c.StopExposure()
-
-    def poll(self):
-        if not self.parent.param["cam/run"]:
+        if self.thread is None:
+            return
+        self.acquiring = False
+        self.thread.join()
+        self.thread = None
+        msg = "Stopped"
+        try:
+            # Fails when the camera is gone, what was read is still saved.
+            try:
+                if self.video:
+                    self.c.StopVideoCapture()
+                else:
+                    self.c.StopExposure()
+            except pc.Error as e:
+                print("Cannot stop the capture: %s" % e)
+            for (im, score, start, header) in self.lucky.flush():
+                self.write(im, start, header, score)
+            if self.parent.param["cam/lucky"] and self.lucky.seen:
+                msg += ", " + self.lucky.status()
+        finally:
+            if self.writer is not None:
+                self.writer.close()
+                msg += ", " + self.writer.status()
+                self.writer = None
+            if self.recorder is not None:
+                self.recorder.close()
+                msg += ", recording " + self.recorder.status()
+                self.recorder = None
+        self.parent.set_status(msg)
+
+    def retry(self, failures: int, what: str, e: Exception) -> bool:
+        """Report an error of the acquisition thread and wait before
+        trying again, False once it must give up."""
+        msg = "%s failed: %s" % (what, e)
+        print(msg)
+        if failures >= MAX_FAILURES:
+            GLib.idle_add(self.failed, msg)
             return False
-        if self.typ == "zwo":
-            failed = False
-            st = self.c.GetExpStatus()
-            if st == pc.EXP_IDLE:
-                print("Internal Error: Callback while no exposure")
-                return False
-            elif st == pc.EXP_WORKING:
-                return True
-            elif st == pc.EXP_FAILED:
-                print("Exposure failed!")
-                failed = True
-            if st == pc.EXP_SUCCESS:
-                im = self.c.GetDataAfterExp()
-                if not self.image or not self.image.redrawing:
-                    self.image = Image("", self.parent)
-                    self.image.process(
-                        self.parent.param, im, self.cam_mode, self.bayer)
-            if self.new_par:
-                self.update()
-                self.new_par = False
-            self.c.StartExposure(0)
-            if failed:
-                self.parent.set_status("Exposing after failure")
-            else:
-                self.parent.set_status("Exposing")
+        time.sleep(min(0.05 * 2 ** failures, 2.0))
         return True
 
+    def run_snapshot(self):
+        """Acquisition thread of the snapshot mode.
+
+        The next exposure is started as soon as a frame is read out,
+        before it is handed to the main loop, so no exposure time is
+        lost to display. Errors are handled as in run_video, starting
+        over with a new exposure.
+        """
+        failures = 0
+        started = None
+        while self.acquiring:
+            try:
+                if started is None:
+                    self.c.StartExposure(0)
+                    started = time.monotonic()
+                    started_utc = time.time()
+                st = self.c.GetExpStatus()
+                if st == pc.EXP_WORKING:
+                    left = (started +
+                            self.parent.param["cam/expo_us"] / 1e6 -
+                            time.monotonic())
+                    time.sleep(min(max(left, 0.002), 0.05))
+                    continue
+                timer = StageTimer("cam")
+                im = None
+                if st == pc.EXP_SUCCESS:
+                    im = timer.call("readout", self.c.GetDataAfterExp)
+                elif st == pc.EXP_FAILED:
+                    GLib.idle_add(
+                        self.parent.set_status, "Exposing after failure")
+                start_utc = started_utc
+                header = self.frame_header(start_utc)
+                if self.new_par:
+                    self.new_par = False
+                    self.update()
+                started = None
+                self.c.StartExposure(0)
+                started = time.monotonic()
+                started_utc = time.time()
+                if im is not None:
+                    self.save(im, start_utc, header, timer)
+                    self.deliver(im, timer)
+            except Exception as e:
+                failures += 1
+                if not self.retry(failures, "Exposure", e):
+                    return
+                if started is not None:
+                    try:
+                        self.c.StopExposure()
+                    except pc.Error:
+                        pass
+                    started = None
+                continue
+            failures = 0
+
+    def run_video(self):
+        """Acquisition thread of the streaming mode.
+
+        Frames are read as fast as the camera delivers them. Errors
+        other than timeouts, as when the camera is unplugged, are
+        retried after a growing delay and stop the capture once
+        MAX_FAILURES happened in a row.
+        """
+        failures = 0
+        while self.acquiring:
+            try:
+                if self.new_par:
+                    # The ROI cannot change while capturing.
+                    self.new_par = False
+                    self.c.StopVideoCapture()
+                    self.update()
+                    self.c.StartVideoCapture()
+                wait_ms = self.parent.param["cam/expo_us"] // 500 + 500
+                timer = StageTimer("cam")
+                try:
+                    im = timer.call("readout", self.c.GetVideoData, wait_ms)
+                except pc.Error as e:
+                    if e.code == pc.ERROR_TIMEOUT:
+                        continue
+                    raise
+                self.save(
+                    im, time.time() - self.parent.param["cam/expo_us"] / 1e6,
+                    timer=timer)
+                self.deliver(im, timer)
+            except Exception as e:
+                failures += 1
+                if not self.retry(failures, "Video capture", e):
+                    return
+                continue
+            failures = 0
+
+    def failed(self, msg):
+        """Stop after the acquisition thread gave up."""
+        self.stop()
+        self.parent.menu.update_ui(self.parent.param)
+        self.parent.set_status(msg)
+
+    def frame_header(self, start):
+        """FITS cards describing a frame whose exposure began at start."""
+        p = self.parent.param
+        header = {
+            "DATE-OBS": (
+                time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(start)) +
+                ".%03d" % int(start % 1 * 1000), "UTC start of exposure"),
+            "EXPTIME": (p["cam/expo_us"] / 1e6, "[s] Exposure time"),
+            "GAIN": (p["cam/gain"], "Sensor gain"),
+            "OFFSET": (p["cam/brightness"], "Sensor offset"),
+            "XBINNING": p["cam/bin"],
+            "YBINNING": p["cam/bin"],
+            "INSTRUME": self.name,
+        }
+        if self.bayer != "NONE" and self.cam_mode in (0, 2):
+            header["BAYERPAT"] = self.bayer
+        indi = self.parent.indi
+        if indi is not None and indi.telescope:
+            header["RA"] = (indi.ra * 15.0, "[deg] Telescope RA, JNow")
+            header["DEC"] = (indi.dec, "[deg] Telescope Dec, JNow")
+        return header
+
+    def save(self, im, start, header=None, timer=None):
+        """Queue a frame for the FITS writer and the SER recorder.
+
+        Called from the acquisition thread, start is the UTC start of
+        the exposure. With cam/lucky only the sharpest frames are
+        queued, a batch at a time.
+        """
+        p = self.parent.param
+        if not (p["cam/save"] or p["cam/record"]):
+            return
+        if p["cam/lucky"]:
+            self.lucky.configure(
+                p["cam/lucky_keep"] / 100.0, p["cam/lucky_batch"],
+                p["cam/lucky_box"],
+                self.bayer != "NONE" and self.cam_mode in (0, 2))
+            if timer is not None:
+                kept = timer.call("lucky", self.lucky.add, im, start, header)
+            else:
+                kept = self.lucky.add(im, start, header)
+        else:
+            # What was kept before lucky imaging was turned off first.
+            kept = self.lucky.flush() + [(im, None, start, header)]
+        for (im, score, start, header) in kept:
+            self.write(im, start, header, score)
+
+    def write(self, im, start, header=None, score=None):
+        p = self.parent.param
+        if p["cam/save"]:
+            if self.writer is None:
+                self.writer = FitsWriter(
+                    p["cam/save_queue"], p["cam/save_batch"])
+            if header is None:
+                header = self.frame_header(start)
+            if score is not None:
+                header = dict(header, SHARPNES=(
+                    score, "Laplacian variance, lucky imaging"))
+            self.writer.put(p["cam/prefix"], im, header)
+        if p["cam/record"]:
+            if self.recorder is None:
+                color = "NONE"
+                if self.cam_mode in (0, 2):
+                    color = self.bayer
+                indi = self.parent.indi
+                self.recorder = SerWriter(
+                    p["cam/prefix"], color, self.name,
+                    (indi.telescope or "") if indi else "",
+                    p["cam/record_queue"])
+            self.recorder.put(im, start)
+
+    def deliver(self, im, timer):
+        """Queue a frame for display, from the acquisition thread.
+
+        The achieved rate, the frames dropped by the SDK and the ones
+        never shown are reported about once a second. With cam/stack
+        the stack of the frames so far is shown instead of the frame.
+        """
+        p = self.parent.param
+        if p["cam/stack"]:
+            self.stack.configure(
+                p["cam/stack_mode"], p["cam/stack_frames"],
+                p["cam/stack_sigma"])
+            im = timer.call("stack", self.stack.add, im)
+        self.queue.put((im, timer, self.origin))
+        with self.lock:
+            if not self.show_pending:
+                self.show_pending = True
+                GLib.idle_add(self.show_next)
+        self.frames += 1
+        now = time.monotonic()
+        if now - self.rate_start < 1.0:
+            return
+        self.fps = self.frames / (now - self.rate_start)
+        if self.video:
+            self.dropped = self.c.GetDroppedFrames()
+        self.frames = 0
+        self.rate_start = now
+        msg = "%s %.1f fps, %d dropped, %d skipped" % (
+            "Streaming" if self.video else "Exposing",
+            self.fps, self.dropped, self.queue.dropped)
+        if p["cam/roi"]:
+            msg += ", ROI %dx%d" % (im.shape[1], im.shape[0])
+        if p["cam/stack"]:
+            msg += ", stacking %d" % min(self.stack.n, self.stack.frames)
+        if p["cam/lucky"] and self.lucky.seen:
+            msg += ", " + self.lucky.status()
+        if self.writer is not None:
+            msg += ", " + self.writer.status()
+        if self.recorder is not None:
+            msg += ", recording " + self.recorder.status()
+        GLib.idle_add(self.parent.set_status, msg)
+
+    def show_next(self):
+        """Render the newest queued frame once the renderer is free."""
+        with self.lock:
+            self.show_pending = False
+        if self.image and self.image.redrawing:
+            return
+        frame = self.queue.newest()
+        if frame is None:
+            return
+        (im, timer, origin) = frame
+        self.image = Image("", self.parent)
+        self.image.origin = origin
+        self.image.displayed = self.show_next
+        self.image.process(
+            self.parent.param, im, self.cam_mode, self.bayer, timer)
+
     def update(self):
+        # Frames taken with other settings do not stack.
+        self.stack.restart()
         if self.typ == "zwo":
+            self.c.pool.count = self.pool_size()
             caps = self.c.GetCameraProperty()
             self.cam_mode = self.parent.param["cam/mode"]
             ok = True
+            (width, height, x, y) = self.roi(caps)
             try:
                 self.c.SetROIFormat(
-                    caps.MaxWidth, caps.MaxHeight,
+                    width, height,
                     self.parent.param["cam/bin"],
                     self.parent.param["cam/mode"])
+                self.c.SetStartPos(x, y)
             except pc.Error:
                 ok = False
+            else:
+                self.origin = (x, y)
             try:
                 self.c.SetControlValue(
                     pc.EXPOSURE, self.parent.param["cam/expo_us"], False)
@@ -264,7 +641,62 @@ class Cam:
                 except pc.Error:
                     ok = False
             if not ok and self.controls_dialog:
-                self.controls_dialog.update_controls()
+                GLib.idle_add(self.controls_dialog.update_controls)
+
+    def roi(self, caps):
+        """Size and start of the frames to read, in binned pixels.
+
+        The full sensor, or with cam/roi a cam/roi_size square centered
+        on cam/roi_x, cam/roi_y as far as the sensor edges allow.
+        """
+        p = self.parent.param
+        b = p["cam/bin"]
+        # The SDK wants widths multiple of 8 and heights of 2.
+        width = caps.MaxWidth // b // 8 * 8
+        height = caps.MaxHeight // b // 2 * 2
+        if not p["cam/roi"]:
+            return (width, height, 0, 0)
+        size = max(p["cam/roi_size"] // b // 8 * 8, 8)
+        w = min(size, width)
+        h = min(size, height)
+        # Even starts keep the Bayer pattern of the full frame.
+        x = min(max(p["cam/roi_x"] // b - w // 2, 0), width - w) // 2 * 2
+        y = min(max(p["cam/roi_y"] // b - h // 2, 0), height - h) // 2 * 2
+        return (w, h, x, y)
+
+    def focus_on(self, x, y):
+        """Read only a ROI centered on x, y of the frame shown."""
+        p = self.parent.param
+        (ox, oy) = self.image.origin
+        p["cam/roi_x"] = int((ox + x) * p["cam/bin"])
+        p["cam/roi_y"] = int((oy + y) * p["cam/bin"])
+        p["cam/roi"] = True
+        self.new_par = True
+        self.parent.menu.update_ui(p)
+        self.parent.set_status("Focusing on %d, %d" % (
+            p["cam/roi_x"], p["cam/roi_y"]))
+
+    def focus_brightest(self):
+        """Center the ROI on the brightest star of the frame shown."""
+        image = self.image
+        if image is None or image.raw is None:
+            self.parent.menu.update_ui(self.parent.param)
+            self.parent.set_status("No frame to pick a star from")
+            return
+        focuser = image.focuser
+        if focuser is not None and focuser.num() > 0:
+            star = focuser.sources[np.argmax(focuser.sources["peak"])]
+            (x, y) = (star["xcentroid"], star["ycentroid"])
+        else:
+            (x, y) = brightest_star(
+                to_gray(image.raw, image.bayer),
+                self.parent.param["focuser/fwhm"])
+        self.focus_on(x, y)
+
+    def full_frame(self):
+        self.parent.param["cam/roi"] = False
+        self.new_par = True
+        self.parent.menu.update_ui(self.parent.param)
 
     def controls(self):
         if not self.controls_dialog:
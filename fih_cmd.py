@@ -117,6 +117,8 @@ class ImagerCmd(Gtk.MenuBar):
             file_menu, "Load Configuration", self.load_conf)
         self.add_entry(
             file_menu, "Save Configuration", self.save_conf)
+        self.add_entry(
+            file_menu, "Save Timings", self.save_timings)
         self.add_separator(file_menu)
         self.add_entry(file_menu, "INDI Menu", self.show_indi)
         self.add_separator(file_menu)
@@ -132,6 +134,12 @@ class ImagerCmd(Gtk.MenuBar):
             view_menu, "Zoom to fit", self.scale, True)
         self.w["invert"] = self.add_check(
             view_menu, "Invert", self.invert, False)
+        self.w["preview"] = self.add_check(
+            view_menu, "Fast preview", self.preview, True)
+        self.w["mmap"] = self.add_check(
+            view_menu, "Memory-mapped loading", self.mmap, True)
+        self.w["timing"] = self.add_check(
+            view_menu, "Show timings", self.timing, False)
         self.add_separator(view_menu)
         for n in (0, 1, 10, 50, 100):
             self.w[f"histogram_stretch_percent_{n}"] = self.add_radio(
@@ -144,6 +152,24 @@ class ImagerCmd(Gtk.MenuBar):
             cam_menu, "Controls", self.cam_controls)
         self.w["cam_run"] = self.add_check(
             cam_menu, "Run", self.cam_run)
+        self.w["cam_video"] = self.add_check(
+            cam_menu, "Video mode", self.cam_video)
+        self.w["cam_save"] = self.add_check(
+            cam_menu, "Save frames", self.cam_save)
+        self.w["cam_record"] = self.add_check(
+            cam_menu, "Record SER video", self.cam_record)
+        self.w["cam_lucky"] = self.add_check(
+            cam_menu, "Save only the sharpest frames", self.cam_lucky)
+        self.w["cam_roi"] = self.add_check(
+            cam_menu, "Focus ROI on brightest star", self.cam_roi)
+        self.w["cam_stack"] = self.add_check(
+            cam_menu, "Live stack", self.cam_stack)
+        for mode, label in (("window", "Stack last frames"),
+                            ("decay", "Stack with decay")):
+            self.w[f"stack_mode_{mode}"] = self.add_radio(
+                cam_menu, "stack_mode", label,
+                lambda w, mode=mode: self.sf_stack_mode(w, mode),
+                mode == "window")
         self.add_separator(cam_menu)
         self.w["indi/keys"] = self.add_check(
             cam_menu, "Enable Indi Keys", self.indi_keys,
@@ -164,6 +190,8 @@ class ImagerCmd(Gtk.MenuBar):
             nav_menu, "Sort by date", self.sort_by_date, False)
         self.add_check(
             nav_menu, "Auto reload new pictures", self.auto_reload, False)
+        self.w["metrics"] = self.add_check(
+            nav_menu, "Remember focuser metrics", self.metrics, True)
 
         focuser_menu = self.add_sub_menu("F_ocuser")
         self.w["finder_dao"] = self.add_radio(
@@ -172,6 +200,15 @@ class ImagerCmd(Gtk.MenuBar):
         self.w["finder_iraf"] = self.add_radio(
             focuser_menu, 'star_finder', "Use IRAFStarFinder",
             self.sf_iraf, False)
+        self.w["tiled"] = self.add_check(
+            focuser_menu, "Multi-core detection", self.sf_tiled)
+        self.add_separator(focuser_menu)
+        for n, label in (("exact", "Exact background"),
+                         ("fast", "Fast background"),
+                         ("mesh", "Fast background with gradient")):
+            self.w[f"background_{n}"] = self.add_radio(
+                focuser_menu, 'background', label,
+                lambda w, n=n: self.sf_background(w, n), n == "exact")
         self.add_separator(focuser_menu)
         self.w["show_nothing"] = self.add_radio(
             focuser_menu, 'focuser_show', "Show Nothing",
@@ -243,7 +280,7 @@ class ImagerCmd(Gtk.MenuBar):
         dialog.destroy()
 
     def exit_app(self, w):
-        Gtk.main_quit()
+        self.p.quit()
 
     def force_gray(self, w):
         self.p.set_param("display/force_gray", w.get_active())
@@ -251,6 +288,15 @@ class ImagerCmd(Gtk.MenuBar):
     def invert(self, w):
         self.p.set_param("display/invert", w.get_active())
 
+    def preview(self, w):
+        self.p.set_param("display/preview", w.get_active())
+
+    def mmap(self, w):
+        self.p.set_param("display/mmap", w.get_active())
+
+    def timing(self, w):
+        self.p.set_param("timing/show", w.get_active())
+
     def gamma_stretch(self, w):
         if w.get_active():
             self.p.set_param("display/gamma_stretch", 1.0 / 2.2)
@@ -286,6 +332,9 @@ class ImagerCmd(Gtk.MenuBar):
     def auto_reload(self, w):
         self.p.auto_reload(w.get_active())
 
+    def metrics(self, w):
+        self.p.set_param("multi/metrics", w.get_active())
+
     def sf_dao(self, w):
         if w.get_active():
             self.p.set_param("focuser/finder", "dao")
@@ -294,6 +343,13 @@ class ImagerCmd(Gtk.MenuBar):
         if w.get_active():
             self.p.set_param("focuser/finder", "iraf")
 
+    def sf_tiled(self, w):
+        self.p.set_param("focuser/tiled", w.get_active())
+
+    def sf_background(self, w, n):
+        if w.get_active():
+            self.p.set_param("focuser/background", n)
+
     def sf_show(self, w, n):
         if w.get_active():
             self.p.set_param("focuser/show", n)
@@ -324,6 +380,23 @@ class ImagerCmd(Gtk.MenuBar):
             return
         self.p.set_param("focuser/threshold", val)
 
+    def save_timings(self, w):
+        dialog = Gtk.FileChooserDialog(
+            title="Please choose where to save the timings",
+            parent=self.p, action=Gtk.FileChooserAction.SAVE
+        )
+        dialog.set_current_name("timings.json")
+        dialog.add_buttons(
+            Gtk.STOCK_CANCEL,
+            Gtk.ResponseType.CANCEL,
+            Gtk.STOCK_SAVE,
+            Gtk.ResponseType.OK,
+        )
+        response = dialog.run()
+        if response == Gtk.ResponseType.OK:
+            self.p.save_timings(dialog.get_filename())
+        dialog.destroy()
+
     def save_conf(self, w):
         dest = os.path.join(pathlib.Path.home(), ".config", "fit-image-helper")
         pathlib.Path(dest).mkdir(parents=True, exist_ok=True)
@@ -374,7 +447,8 @@ class ImagerCmd(Gtk.MenuBar):
         dialog.destroy()
 
     def update_ui(self, param):
-        for i in ("force_gray", "invert", "gamma_stretch", "scale"):
+        for i in ("force_gray", "invert", "gamma_stretch", "scale", "mmap",
+                  "preview"):
             self.w[i].set_active(param[f"display/{i}"])
         for i in ("indi/keys"):
             self.w[i].set_active(param[i])
@@ -382,11 +456,23 @@ class ImagerCmd(Gtk.MenuBar):
             "histogram_stretch_percent_"
             f"{param['display/histogram_stretch_percent']}"].set_active(True)
         self.w["sort_timestamp"].set_active(param["multi/sort_timestamp"])
+        self.w["timing"].set_active(param["timing/show"])
+        self.w["metrics"].set_active(param["multi/metrics"])
         self.w["finder_" f"{param['focuser/finder']}"].set_active(True)
         self.w["show_" f"{param['focuser/show']}"].set_active(True)
         self.w["n_stars_" f"{param['focuser/n_stars']}"].set_active(True)
         self.w["text"].set_active(param["focuser/text"])
+        self.w["tiled"].set_active(param["focuser/tiled"])
+        self.w["background_" f"{param['focuser/background']}"].set_active(
+            True)
         self.w["cam_run"].set_active(param["cam/run"])
+        self.w["cam_video"].set_active(param["cam/video"])
+        self.w["cam_save"].set_active(param["cam/save"])
+        self.w["cam_record"].set_active(param["cam/record"])
+        self.w["cam_lucky"].set_active(param["cam/lucky"])
+        self.w["cam_roi"].set_active(param["cam/roi"])
+        self.w["cam_stack"].set_active(param["cam/stack"])
+        self.w["stack_mode_" f"{param['cam/stack_mode']}"].set_active(True)
 
     def open_zwo(self, w):
         ident = list_zwo_cams(self.p)
@@ -398,6 +484,46 @@ class ImagerCmd(Gtk.MenuBar):
         if self.p.cam:
             self.p.cam.controls()
 
+    def cam_save(self, w):
+        self.p.param["cam/save"] = w.get_active()
+        if self.p.cam and self.p.cam.typ == "zwo":
+            self.p.cam.c.pool.count = self.p.cam.pool_size()
+
+    def cam_record(self, w):
+        self.p.param["cam/record"] = w.get_active()
+        if self.p.cam and self.p.cam.typ == "zwo":
+            self.p.cam.c.pool.count = self.p.cam.pool_size()
+
+    def cam_roi(self, w):
+        if w.get_active() == self.p.param["cam/roi"]:
+            return
+        if not self.p.cam:
+            self.p.param["cam/roi"] = w.get_active()
+        elif w.get_active():
+            self.p.cam.focus_brightest()
+        else:
+            self.p.cam.full_frame()
+
+    def cam_stack(self, w):
+        if w.get_active() and self.p.cam and not self.p.param["cam/stack"]:
+            self.p.cam.stack.restart()
+        self.p.param["cam/stack"] = w.get_active()
+
+    def sf_stack_mode(self, w, mode):
+        if w.get_active():
+            self.p.param["cam/stack_mode"] = mode
+
+    def cam_lucky(self, w):
+        self.p.param["cam/lucky"] = w.get_active()
+
+    def cam_video(self, w):
+        running = self.p.cam and self.p.param["cam/run"]
+        if running:
+            self.p.cam.stop()
+        self.p.param["cam/video"] = w.get_active()
+        if running:
+            self.p.cam.start()
+
     def cam_run(self, w):
         if not self.p.cam:
             return
@@ -0,0 +1,93 @@
+from astropy.io import fits
+import numpy as np
+from typing import Any, Tuple
+
+
+class FitsData:
+    """Pixel data of the primary HDU of a FITS file.
+
+    With mmap the data section is mapped read-only and pixels are only
+    converted to native byte order (and shifted for the unsigned integer
+    BZERO convention) for the region passed to read(). Compressed or
+    really scaled (BSCALE != 1 or arbitrary BZERO) files are loaded
+    eagerly by astropy as before.
+    """
+
+    def __init__(self, filename: str, mmap: bool = True):
+        self.filename = filename
+        self.raw: Any = None
+        self.mapped = False
+        self.flip = 0
+        if mmap:
+            self.open_mapped()
+        if not self.mapped:
+            self.open_eager()
+        if self.raw is None:
+            raise ValueError("Empty data from FITS file")
+        self.shape: Tuple[int, ...] = self.raw.shape
+        self.height = self.shape[0]
+        self.width = self.shape[1]
+
+    def open_mapped(self):
+        if self.filename.lower().endswith((".gz", ".fz", ".bz2", ".zip")):
+            return
+        with fits.open(self.filename, memmap=True, mode="readonly",
+                       do_not_scale_image_data=True) as hdul:
+            hdu = hdul[0]
+            if isinstance(hdu, fits.CompImageHDU):
+                return
+            header = hdu.header
+            raw = hdu.data
+        if raw is None:
+            return
+        bscale = header.get("BSCALE", 1)
+        bzero = header.get("BZERO", 0)
+        if bscale != 1:
+            return
+        if bzero != 0:
+            if raw.dtype.kind != "i":
+                return
+            sign = 1 << (raw.dtype.itemsize * 8 - 1)
+            if bzero != sign:
+                return
+            # Unsigned data stored as signed: adding BZERO is just
+            # flipping the sign bit.
+            raw = raw.view(raw.dtype.newbyteorder(">").str.replace("i", "u"))
+            self.flip = sign
+        self.header = header
+        self.raw = raw
+        self.mapped = True
+
+    def open_eager(self):
+        hdul = fits.open(self.filename)
+        self.header = hdul[0].header
+        self.raw = hdul[0].data
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.raw.dtype.newbyteorder("=")
+
+    def read(self, rows=slice(None), cols=slice(None)) -> np.ndarray:
+        """Return a native, contiguous copy of raw[rows, cols]."""
+        src = self.raw[rows, cols]
+        if not self.mapped:
+            return np.ascontiguousarray(src, dtype=self.dtype)
+        out = np.empty(src.shape, dtype=self.dtype)
+        if self.flip:
+            np.bitwise_xor(src, self.flip, out=out, casting="unsafe")
+        else:
+            out[...] = src
+        return out
+
+    def read_rows(self, step: int, group: int = 1) -> np.ndarray:
+        """Return the first group rows of every step * group rows.
+
+        Mapped files only have the pages of those rows read, as long as
+        a row is at least a page long.
+        """
+        if step <= 1:
+            return self.read()
+        if group == 1:
+            return self.read(slice(None, None, step))
+        starts = np.arange(0, self.height - group + 1, step * group)
+        return self.read((starts[:, None] + np.arange(group)).ravel())
@@ -1,28 +1,40 @@
-
-from astropy.io import fits
+import os
 import numpy as np
 import cv2
-import threading
 import gi
 import cairo
 from focuser import Focuser
-from typing import Dict, Any, Tuple, Optional
+from fih_fits import FitsData
+from fih_render import Token
+from fih_timing import StageTimer, out_bytes
+from fih_pixels import (
+    BAYER_CONV, stretch_lut, apply_lut, superpixel_debayer)
+from fih_stats import Quantiles
+from typing import Callable, Dict, Any, Tuple, Optional
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, GLib, Gdk
 
 
 class Image:
 
-    CONV = {
-        "GRBG": (cv2.COLOR_BAYER_GR2RGBA, cv2.COLOR_BAYER_GR2RGB),
-        "GRBGi": (cv2.COLOR_BAYER_GR2BGRA, cv2.COLOR_BAYER_GR2BGR),
-        "RGGB": (cv2.COLOR_BAYER_RG2RGBA, cv2.COLOR_BAYER_RG2RGB),
-        "RGGBi": (cv2.COLOR_BAYER_RG2BGRA, cv2.COLOR_BAYER_RG2BGR),
-        "BGGR": (cv2.COLOR_BAYER_BG2RGBA, cv2.COLOR_BAYER_BG2RGB),
-        "BGGRi": (cv2.COLOR_BAYER_BG2BGRA, cv2.COLOR_BAYER_BG2BGR),
-        "GBRG": (cv2.COLOR_BAYER_GB2RGBA, cv2.COLOR_BAYER_GB2RGB),
-        "GBRGi": (cv2.COLOR_BAYER_GB2BGRA, cv2.COLOR_BAYER_GB2BGR),
-    }
+    CONV = BAYER_CONV
+
+    # Render stages, in order, with the parameters each one depends on.
+    # A stage output is cached and only recomputed when one of its
+    # parameters or an upstream stage changed. "preview" is derived
+    # after loading, see preview_size().
+    STAGES = (
+        ("load", ()),
+        ("debayer", ("display/lab", "preview")),
+        ("gray", ("display/force_gray",)),
+        ("scale", ("display/scale", "viewport")),
+        ("stretch", ("display/histogram_stretch_percent",
+                     "display/gamma_stretch", "display/invert")),
+        ("colorize", ()),
+        ("overlay", ("focuser/finder", "focuser/show", "focuser/n_stars",
+                     "focuser/text", "focuser/fwhm", "focuser/threshold",
+                     "focuser/tiled", "focuser/background")),
+    )
 
     def __init__(
             self, filename: str, parent: Gtk.Widget):
@@ -30,11 +42,22 @@ class Image:
         self.box = parent.scroll
         self.filename = filename
         self.parent = parent
+        self.fits: Optional[FitsData] = None
+        self.key: Optional[Tuple] = None
+        self.raw: Optional[np.ndarray] = None
         self.data: Optional[np.ndarray] = None
         self.cdata: Optional[np.ndarray] = None
+        self.stages: Dict[str, Tuple[Tuple, Any]] = {}
         self.focuser: Optional[Focuser] = None
+        # Bumped whenever data and cdata are computed again.
+        self.generation = 0
+        self.focuser_key: Optional[Tuple] = None
         self.percentiles: Dict[int, Tuple[float, float]] = {}
         self.redrawing = False
+        # Called in the main loop once a frame from process() is done.
+        self.displayed: Optional[Callable[[], None]] = None
+        # Position of camera ROI frames on the sensor, in binned pixels.
+        self.origin = (0, 0)
         self.width = 0
         self.height = 0
         self.black = 0
@@ -45,55 +68,206 @@ class Image:
         self.parent.set_status(msg)
         self.parent.broken(self.filename)
 
-    def load(self, param: Dict[str, Any]) -> bool:
+    def nbytes(self) -> int:
+        """Memory held by the frame and the outputs of its stages."""
+        outs = [self.raw, self.data, self.cdata]
+        if self.fits is not None and not self.fits.mapped:
+            outs.append(self.fits.raw)
+        outs.extend(out for (_, out) in list(self.stages.values()))
+        seen: Dict[int, int] = {}
+        while outs:
+            out = outs.pop()
+            if isinstance(out, (tuple, list)):
+                outs.extend(out)
+            elif out is not None:
+                seen[id(out)] = out_bytes(out)
+        return sum(seen.values())
+
+    def load(self, param: Dict[str, Any], report: bool = True) -> bool:
         try:
-            hdul = fits.open(self.filename)
-            self.data = hdul[0].data
-            if self.data is None:
-                raise ValueError("Empty data from FITS file")
-            header = hdul[0].header
-            self.height = self.data.shape[0]
-            self.width = self.data.shape[1]
+            self.fits = FitsData(self.filename, param["display/mmap"])
+            header = self.fits.header
+            self.height = self.fits.height
+            self.width = self.fits.width
         except Exception as e:
-            msg = "Cannot load %s: %s" % (self.filename, str(e))
-            GLib.idle_add(self.report_error, msg)
+            if report:
+                msg = "Cannot load %s: %s" % (self.filename, str(e))
+                GLib.idle_add(self.report_error, msg)
             return False
-        self.black = np.iinfo(self.data.dtype).min
-        self.white = np.iinfo(self.data.dtype).max
+        self.black = np.iinfo(self.fits.dtype).min
+        self.white = np.iinfo(self.fits.dtype).max
         try:
             self.black = header["CBLACK"]
             self.white = header["CWHITE"]
         except KeyError:
             pass
         self.bayer = "NONE"
-        self.cdata = None
         try:
             self.bayer = header["BAYERPAT"]
         except KeyError:
             pass
-        self.debayer(param)
         return True
 
+    def read_pixels(self, preview: Optional[Tuple[int, int]]) -> np.ndarray:
+        """Pixels to debayer, for previews only every few rows.
+
+        Previews keep at least one row, or row of Bayer cells, per
+        display row and are read straight from the file, so that the
+        pages of the other rows are never touched. The full frame is
+        read once and kept.
+        """
+        if self.raw is not None or self.fits is None:
+            return self.raw
+        if preview is not None:
+            cells = 2 if self.bayer != "NONE" else 1
+            step = int(self.height / preview[1] / cells)
+            if step > 1:
+                return self.fits.read_rows(step, cells)
+        self.raw = self.fits.read()
+        return self.raw
+
     def debayer(self, param):
+        self.generation += 1
+        self.data = None
+        self.cdata = None
+        self.percentiles = {}
+        preview = param.get("preview")
+        raw = self.read_pixels(preview)
         if self.bayer == "NONE":
+            if raw.ndim == 2:
+                self.data = raw
+            else:
+                self.cdata = raw
             return
-        if param["display/lab"]:
-            d = cv2.cvtColor(self.data, self.CONV[self.bayer][1])
+        if preview is not None:
+            d = superpixel_debayer(
+                raw, self.CONV[self.bayer][0], preview[0], preview[1])
+            if param["display/lab"]:
+                d = d[:, :, :3].astype(np.float32) / 65535.0
+                d = cv2.cvtColor(d, cv2.COLOR_RGB2HLS)
+            self.cdata = d
+        elif param["display/lab"]:
+            d = cv2.cvtColor(raw, self.CONV[self.bayer][1])
             d = d.astype(np.float32) / 65535.0
             self.cdata = cv2.cvtColor(d, cv2.COLOR_RGB2HLS)
         else:
-            self.cdata = cv2.cvtColor(self.data, self.CONV[self.bayer][0])
-        self.data = None
+            self.cdata = cv2.cvtColor(raw, self.CONV[self.bayer][0])
+
+    def preview_size(self, param: Dict[str, Any]) -> Optional[Tuple[int, int]]:
+        """Display size to read for when the full frame is not needed.
+
+        Frames shown zoomed to fit at least 2x smaller than the sensor
+        are only read every few rows (see read_pixels) and Bayer ones
+        demosaiced with superpixels straight to display size. The full
+        resolution read and decode wait for 1:1 zoom or the focuser.
+        """
+        if (not param.get("display/preview") or
+                not param.get("display/scale") or
+                param.get("focuser/show", "nothing") != "nothing"):
+            return None
+        (scale, width, height) = self.fit_size(param)
+        if scale < 2:
+            return None
+        return (width, height)
 
     def make_gray(self):
-        self.data = cv2.cvtColor(self.cdata, cv2.COLOR_RGBA2GRAY)
+        if self.data is None:
+            self.data = cv2.cvtColor(self.cdata, cv2.COLOR_RGBA2GRAY)
+
+    def run_stages(self, param: Dict[str, Any], token: Token,
+                   last: str = "overlay",
+                   timer: Optional[StageTimer] = None) -> Any:
+        key: Tuple = ()
+        out = None
+        for name, deps in self.STAGES:
+            key = key + tuple(param.get(d) for d in deps)
+            cached = self.stages.get(name)
+            if cached is not None and cached[0] == key:
+                out = cached[1]
+            else:
+                if token.cancelled:
+                    return None
+                stage = getattr(self, "stage_" + name)
+                if timer is None:
+                    out = stage(out, param)
+                else:
+                    out = timer.call(name, stage, out, param)
+                if out is None:
+                    return None
+                self.stages[name] = (key, out)
+            if name == "load":
+                param = dict(param, preview=self.preview_size(param))
+            if name == last:
+                break
+        return out
+
+    def stage_load(self, prev, param: Dict[str, Any]) -> Any:
+        if self.raw is None and self.fits is None:
+            if not self.load(param):
+                return None
+            self.parent.image_loaded(self)
+        if self.fits is not None:
+            return self.fits
+        return self.raw
+
+    def stage_debayer(self, raw: np.ndarray, param: Dict[str, Any]) -> Any:
+        self.debayer(param)
+        if self.cdata is not None:
+            return self.cdata
+        return self.data
+
+    def stage_gray(self, img: np.ndarray, param: Dict[str, Any]) -> Any:
+        if param["display/force_gray"] and img.ndim == 3:
+            self.make_gray()
+            return self.data
+        return img
 
-    def gtk_display(self, surface: cairo.Surface, msg: str, gen: int):
-        if self.parent.generation != gen:
+    def stage_scale(self, img: np.ndarray, param: Dict[str, Any]) -> Any:
+        return self.do_scale(img, param)
+
+    def stage_stretch(self, prev: Tuple, param: Dict[str, Any]) -> Any:
+        (img, scale, width, height) = prev
+        if param["display/lab"] and img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_HLS2BGR) * 255
+            img = cv2.cvtColor(img, cv2.COLOR_RGB2BGRA)
+            img = img.astype(np.uint8)
+            if param["display/invert"]:
+                img = 255 - img
+        else:
+            img = self.do_stretch(img, param)
+        return (img, scale, width, height)
+
+    def stage_colorize(self, prev: Tuple, param: Dict[str, Any]) -> Any:
+        (img, scale, width, height) = prev
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGBA)
+        return (img, scale, width, height)
+
+    def stage_overlay(self, prev: Tuple, param: Dict[str, Any]) -> Any:
+        (img, scale, width, height) = prev
+        if param["focuser/show"] != "nothing":
+            # Keep the colorized frame clean for later overlays.
+            img = img.copy()
+        surface = cairo.ImageSurface.create_for_data(
+            img.data, cairo.FORMAT_RGB24, width, height)
+        self.do_focuser(surface, param, scale)
+        msg = "Loaded %s" % self.filename
+        if param["focuser/show"] != "nothing" and self.focuser:
+            msg = msg + ", found %d stars" % self.focuser.num()
+        return (surface, msg)
+
+    def gtk_display(self, surface: cairo.Surface, msg: str, token: Token):
+        if not token.cancelled:
+            self.widget.set_from_surface(surface)
+            self.parent.set_status(msg)
+        self.redraw_done()
+
+    def redraw_done(self):
+        if not self.redrawing:
             return
         self.redrawing = False
-        self.widget.set_from_surface(surface)
-        self.parent.set_status(msg)
+        if self.displayed is not None:
+            self.displayed()
 
     def histogram_stretch(
             self, img: np.ndarray, percent: int) -> Tuple[float, float]:
@@ -103,7 +277,7 @@ class Image:
             if self.data is None:
                 self.make_gray()
             want = [0.05, 0.5, 2.5, 5.0, 95.0, 97.5, 99.5, 99.95]
-            p = np.percentile(self.data, want)
+            p = Quantiles(self.data).percentile(want)
             self.percentiles = {
                 1: (p[0], p[len(want) - 1]),
                 10: (p[1], p[len(want) - 2]),
@@ -116,22 +290,41 @@ class Image:
             self, img: np.ndarray, gamma: float) -> np.ndarray:
         return img ** gamma
 
-    def do_scale(
-            self, img: np.ndarray, param: Dict[str, Any]
-    ) -> Tuple[np.ndarray, float, int, int]:
+    def fit_size(self, param: Dict[str, Any]) -> Tuple[float, int, int]:
         scale = 1
         width = self.width
         height = self.height
         if param["display/scale"]:
-            box = self.box.get_allocation()
-            scale_w = width / box.width
-            scale_h = height / box.height
+            (box_width, box_height) = param["viewport"]
+            scale_w = width / box_width
+            scale_h = height / box_height
             if scale_w > scale_h:
                 scale = scale_w
             else:
                 scale = scale_h
             width = int(width / scale)
             height = int(height / scale)
+        return (scale, width, height)
+
+    def frame_pos(self, param: Dict[str, Any], x: float, y: float
+                  ) -> Optional[Tuple[float, float]]:
+        """Frame pixel under the widget position x, y, if any."""
+        (scale, width, height) = self.fit_size(
+            dict(param, viewport=self.viewport(param)))
+        alloc = self.widget.get_allocation()
+        # Gtk.Image centers what it shows.
+        x = (x - max(alloc.width - width, 0) / 2) * scale
+        y = (y - max(alloc.height - height, 0) / 2) * scale
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        return (x, y)
+
+    def do_scale(
+            self, img: np.ndarray, param: Dict[str, Any]
+    ) -> Tuple[np.ndarray, float, int, int]:
+        (scale, width, height) = self.fit_size(param)
+        # Preview frames already come at display size.
+        if img.shape[:2] != (height, width):
             if scale > 1:
                 interpol = cv2.INTER_AREA
             else:
@@ -148,133 +341,161 @@ class Image:
             (cmin, cmax) = self.histogram_stretch(
                 img, param["display/histogram_stretch_percent"])
         gamma = param["display/gamma_stretch"]
+        if img.dtype in (np.uint8, np.uint16):
+            lut = stretch_lut(
+                img.dtype.itemsize * 8, float(cmin), float(cmax),
+                float(gamma), param["display/invert"])
+            return apply_lut(img, lut)
         if gamma > 0:
             img = self.gamma_stretch(img, gamma)
             cmin = cmin ** gamma
             cmax = cmax ** gamma
-        return np.clip((img - cmin) / ((cmax - cmin) / 255.0), 0, 255)
+        img = np.clip((img - cmin) / ((cmax - cmin) / 255.0), 0, 255)
+        img = img.astype(np.uint8)
+        if param["display/invert"]:
+            img = 255 - img
+        return img
 
     def do_focuser(
             self, surface: cairo.Surface, param: Dict[str, Any],
-            op: str, scale: float):
+            scale: float):
         if param["focuser/show"] == "nothing":
             return
         cr = cairo.Context(surface)
-        if (self.focuser is None or
-                op == "new" or op.startswith("focuser/")):
+        self.make_gray()
+        key = (self.generation, param["focuser/finder"],
+               param["focuser/n_stars"], param["focuser/fwhm"],
+               param["focuser/threshold"], param["focuser/tiled"],
+               param["focuser/background"])
+        if self.focuser is None or self.focuser_key != key:
+            workers = 0
+            if param["focuser/tiled"]:
+                workers = os.cpu_count() or 0
             self.focuser = Focuser(
                 algo=param["focuser/finder"],
                 n_stars=param["focuser/n_stars"],
                 fwhm=param["focuser/fwhm"],
-                threshold_stds=param["focuser/threshold"])
-            if self.data is None:
-                self.make_gray()
-            self.focuser.evaluate(self.data)
-            if param["focuser/show"] == "hfr":
-                self.focuser.hfr(self.data)
+                threshold_stds=param["focuser/threshold"],
+                workers=workers,
+                background=param["focuser/background"])
+            self.focuser_key = key
+            if not self.restore_metrics(param):
+                self.focuser.evaluate(self.data)
+                self.save_metrics(param)
+        if (param["focuser/show"] == "hfr" and
+                "hfr" not in self.focuser.mean):
+            self.focuser.hfr(self.data)
+            self.save_metrics(param)
         self.focuser.draw(cr, param["focuser/show"], scale=scale,
                           show_text=param["focuser/text"])
 
-    def thread_display(self, param: Dict[str, Any], op: str, gen: int):
-        if self.parent.generation != gen:
+    def restore_metrics(self, param: Dict[str, Any]) -> bool:
+        store = self.parent.metrics_store(param)
+        if store is None or self.key is None:
+            return False
+        hit = store.get(self.filename, param)
+        if hit is None:
+            return False
+        self.focuser.restore(*hit)
+        return True
+
+    def save_metrics(self, param: Dict[str, Any]):
+        store = self.parent.metrics_store(param)
+        if store is None or self.key is None:
             return
-        if self.data is None and self.cdata is None:
-            if not self.load(param):
+        summary = dict(self.focuser.summary(), width=self.width,
+                       height=self.height, bayer=self.bayer)
+        store.put(self.filename, param, summary, self.focuser.arrays())
+        GLib.idle_add(self.parent.metrics_updated, self.filename, summary)
+
+    def thread_display(self, param: Dict[str, Any], token: Token,
+                       rkey: Optional[Tuple] = None,
+                       timer: Optional[StageTimer] = None):
+        shown = False
+        try:
+            if timer is None:
+                timer = StageTimer(self.filename)
+            out = self.run_stages(param, token, timer=timer)
+            if out is None or token.cancelled:
                 return
-        if self.parent.generation != gen:
-            return
-        if param["display/force_gray"] and self.data is None:
-            self.make_gray()
-        is_gray = self.cdata is None or param["display/force_gray"]
-        if is_gray:
-            img = self.data
-        else:
-            img = self.cdata
-        if self.parent.generation != gen:
-            return
-        if img is None:
-            self.redrawing = False
-            self.parent.set_status("Empty Image")
-            return
-        (img, scale, width, height) = self.do_scale(img, param)
-        if self.parent.generation != gen:
-            return
-        if param["display/lab"]:
-            if not is_gray:
-                img = cv2.cvtColor(img, cv2.COLOR_HLS2BGR) * 255
-                img = cv2.cvtColor(img, cv2.COLOR_RGB2BGRA)
-        else:
-            img = self.do_stretch(img, param)
-        if img is None:
-            self.redrawing = False
-            self.parent.set_status("Empty Image")
-            return
-        img = img.astype(np.uint8)
-        if param["display/invert"]:
-            img = 255 - img
-        if self.parent.generation != gen:
-            return
-        if is_gray:
-            img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGBA)
-        if self.parent.generation != gen:
-            return
-        if img is None:
-            self.redrawing = False
-            self.parent.set_status("Empty Image")
-            return
-        surface = cairo.ImageSurface.create_for_data(
-            img.data, cairo.FORMAT_RGB24, width, height)
-        if self.parent.generation != gen:
-            return
-        self.do_focuser(surface, param, op, scale)
-        if self.parent.generation != gen:
-            return
-        msg = "Loaded %s" % self.filename
-        if param["focuser/show"] != "nothing" and self.focuser:
-            msg = msg + ", found %d stars" % self.focuser.num()
-        GLib.idle_add(self.gtk_display, surface, msg, gen)
+            (surface, msg) = out
+            self.parent.image_rendered(self)
+            if rkey is not None:
+                self.parent.render_cache.put(rkey, (surface, msg))
+            self.parent.timings.add(timer)
+            if param["timing/show"]:
+                msg = "%s [%s; %s]" % (
+                    msg, timer.summary(), self.parent.timings.summary())
+            GLib.idle_add(self.gtk_display, surface, msg, token)
+            shown = True
+        finally:
+            # gtk_display ends the redraw; anything else must too, or
+            # camera frames stop being shown.
+            if not shown:
+                GLib.idle_add(self.redraw_done)
 
-    def display(self, param: Dict[str, Any], op: str):
+    def viewport(self, param: Dict[str, Any]) -> Optional[Tuple[int, int]]:
+        if not param["display/scale"]:
+            return None
+        box = self.box.get_allocation()
+        return (box.width, box.height)
+
+    def render_key(self, param: Dict[str, Any]) -> Optional[Tuple]:
+        if self.key is None:
+            return None
+        pars = tuple(sorted(
+            (k, v) for k, v in param.items()
+            if k.startswith(("display/", "focuser/"))))
+        return (self.filename, self.key[1], pars, param["viewport"])
+
+    def display(self, param: Dict[str, Any]):
+        param = dict(param, viewport=self.viewport(param))
+        rkey = self.render_key(param)
+        if rkey is not None:
+            hit = self.parent.render_cache.get(rkey)
+            if hit is not None:
+                self.parent.renderer.cancel()
+                self.redrawing = False
+                self.widget.set_from_surface(hit[0])
+                msg = hit[1]
+                if param["timing/show"]:
+                    msg = msg + " [cached]"
+                self.parent.set_status(msg)
+                return
         self.parent.set_status(
             "Loading %s" % self.filename)
-        self.parent.generation = self.parent.generation + 1
-        thread = threading.Thread(
-            target=lambda: self.thread_display(
-                param, op, self.parent.generation))
-        thread.daemon = True
-        thread.start()
-
-    def process(self, param: Dict[str, Any], img, fmt, bayer):
+        self.parent.renderer.submit(
+            lambda token: self.thread_display(param, token, rkey),
+            lambda: GLib.idle_add(self.redraw_done))
+
+    def process(self, param: Dict[str, Any], img, fmt, bayer,
+                timer: Optional[StageTimer] = None):
         if self.redrawing:
             return
-        self.parent.generation = self.parent.generation + 1
         self.height = img.shape[0]
         self.width = img.shape[1]
         self.black = 0
+        self.bayer = "NONE"
         if fmt in (0, 2):
             if fmt == 0:
                 self.white = 255
             else:
                 self.white = 65535
-            self.data = img
+            self.raw = img
             self.bayer = bayer
-            self.debayer(param)
         elif fmt == 1:
             self.white = 255
-            self.cdata = np.stack(
+            self.raw = np.stack(
                 (img[:, :, 0], img[:, :, 1], img[:, :, 2],
                  np.zeros((self.height, self.width), dtype=np.uint8)),
                 axis=2)
-            self.data = None
         elif fmt == 3:
             self.white = 255
-            self.data = img
-            self.cdata = None
+            self.raw = img
         else:
             return
         self.redrawing = True
-        thread = threading.Thread(
-            target=lambda: self.thread_display(
-                param, "new", self.parent.generation))
-        thread.daemon = True
-        thread.start()
+        param = dict(param, viewport=self.viewport(param))
+        self.parent.renderer.submit(
+            lambda token: self.thread_display(param, token, timer=timer),
+            lambda: GLib.idle_add(self.redraw_done))
@@ -0,0 +1,103 @@
+import heapq
+from typing import Any, List, Tuple
+import cv2
+import numpy as np
+
+
+def sharpness(im: np.ndarray, box: int = 512, bayer: bool = False) -> float:
+    """Variance of the Laplacian of the center box x box of a frame.
+
+    Bayer frames are scored on one pixel of every 2x2 cell, RGB frames
+    on their green plane, so the mosaic does not count as detail.
+    """
+    h, w = im.shape[:2]
+    if box > 0:
+        y = max(h - box, 0) // 4 * 2
+        x = max(w - box, 0) // 4 * 2
+        im = im[y:y + box, x:x + box]
+    if bayer:
+        im = im[::2, ::2]
+    if im.ndim == 3:
+        im = im[:, :, 1]
+    lap = cv2.Laplacian(im, cv2.CV_32F)
+    return float(cv2.meanStdDev(lap)[1][0, 0]) ** 2
+
+
+class LuckySelector:
+    """Keep the sharpest frames of a stream.
+
+    Frames come in batches of batch frames, of which the keep fraction
+    with the best sharpness() is kept in a heap and handed back, in the
+    order they came, once the batch is complete. Kept frames are copied
+    to buffers from pool, a pyasicam BufferPool, as camera buffers are
+    reused, and so are only allocated while the ones written out are
+    still in use.
+    """
+
+    def __init__(self, pool: Any, keep: float = 0.1, batch: int = 100,
+                 box: int = 512, bayer: bool = False):
+        self.pool = pool
+        self.heap: List[Tuple] = []
+        self.shape = ()
+        self.dtype = None
+        self.seq = 0
+        self.seen = 0
+        self.kept = 0
+        self.configure(keep, batch, box, bayer)
+
+    def configure(self, keep: float, batch: int, box: int, bayer: bool):
+        self.keep = min(max(keep, 0.0), 1.0)
+        self.batch = max(batch, 1)
+        self.box = box
+        self.bayer = bayer
+        self.want = max(1, int(round(self.keep * self.batch)))
+        while len(self.heap) > self.want:
+            heapq.heappop(self.heap)
+        # The kept frames and as many waiting to be written.
+        self.pool.count = 2 * self.want + 1
+
+    def add(self, im: np.ndarray, *info) -> List[Tuple]:
+        """Score a frame, return the frames kept when a batch ends.
+
+        Returned items are (frame, sharpness, *info).
+        """
+        if im.shape != self.shape or im.dtype != self.dtype:
+            done = self.flush()
+            self.shape = im.shape
+            self.dtype = im.dtype
+            self.pool.reset(im.nbytes)
+        else:
+            done = []
+        score = sharpness(im, self.box, self.bayer)
+        self.seq += 1
+        self.seen += 1
+        if len(self.heap) < self.want:
+            heapq.heappush(self.heap, (score, self.seq, self.copy(im), info))
+        elif score > self.heap[0][0]:
+            # Drop the worst one first, so that its buffer is free.
+            heapq.heappop(self.heap)
+            heapq.heappush(self.heap, (score, self.seq, self.copy(im), info))
+        if self.seq >= self.batch:
+            done += self.flush()
+        return done
+
+    def copy(self, im: np.ndarray) -> np.ndarray:
+        out = self.pool.get()[:im.nbytes].view(im.dtype).reshape(im.shape)
+        np.copyto(out, im)
+        return out
+
+    def flush(self) -> List[Tuple]:
+        """Frames kept from the current batch, which is restarted.
+
+        A partial batch keeps its share of the frames it got.
+        """
+        want = max(1, int(round(self.keep * self.seq))) if self.seq else 0
+        best = heapq.nlargest(want, self.heap)
+        self.heap = []
+        self.seq = 0
+        self.kept += len(best)
+        return [(im, score) + info
+                for (score, _, im, info) in sorted(best, key=lambda b: b[1])]
+
+    def status(self) -> str:
+        return "lucky %d/%d" % (self.kept, self.seen)
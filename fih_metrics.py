@@ -0,0 +1,189 @@
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+
+# Parameters changing what the focuser finds in a file.
+METRIC_PARAMS = ("focuser/finder", "focuser/n_stars", "focuser/fwhm",
+                 "focuser/threshold", "focuser/background", "display/lab")
+
+# Check the size cap every this many writes.
+VACUUM_EVERY = 64
+
+# Write the last use of entries read once this many are pending.
+USED_EVERY = 64
+
+# Paths looked up per query by summaries().
+LOOKUP_BATCH = 500
+
+
+def default_path() -> str:
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        Path.home(), ".cache")
+    return os.path.join(cache, "fit-image-helper", "metrics.sqlite")
+
+
+def params_key(param: Dict[str, Any]) -> str:
+    return json.dumps([param[p] for p in METRIC_PARAMS])
+
+
+def file_stamp(filename: str) -> Optional[Tuple[str, int, int]]:
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+
+
+def pack_arrays(arrays: Dict[str, np.ndarray]) -> bytes:
+    buf = io.BytesIO()
+    np.savez(buf, **arrays)
+    return buf.getvalue()
+
+
+def unpack_arrays(blob: bytes) -> Dict[str, np.ndarray]:
+    with np.load(io.BytesIO(blob), allow_pickle=False) as npz:
+        return {k: npz[k] for k in npz.files}
+
+
+class MetricsStore:
+    """Focuser results of FITS files, kept across sessions in SQLite.
+
+    Entries are keyed by the absolute path and the parameters in
+    METRIC_PARAMS, and only returned while the file size and mtime match
+    what was measured. Each entry has a summary dict (see
+    Focuser.summary) and the arrays needed to redraw the detections. When
+    the database grows over max_mb the least recently used entries are
+    deleted and the file is vacuumed.
+    """
+
+    def __init__(self, path: str = "", max_mb: int = 64):
+        self.path = path or default_path()
+        self.max_bytes = max_mb << 20
+        self.writes = 0
+        # Last use of the entries read since the last write.
+        self.used: Dict[Tuple[str, str], float] = {}
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS metrics ("
+            "path TEXT, params TEXT, size INTEGER, mtime INTEGER, "
+            "summary TEXT, arrays BLOB, used REAL, "
+            "PRIMARY KEY (path, params))")
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS metrics_used ON metrics (used)")
+        self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.write_used()
+            self.db.commit()
+            self.db.close()
+
+    def write_used(self):
+        if not self.used:
+            return
+        self.db.executemany(
+            "UPDATE metrics SET used = ? WHERE path = ? AND params = ?",
+            [(t, path, pkey) for (path, pkey), t in self.used.items()])
+        self.used = {}
+
+    def get(self, filename: str, param: Dict[str, Any],
+            arrays: bool = True
+            ) -> Optional[Tuple[Dict[str, Any], Dict[str, np.ndarray]]]:
+        stamp = file_stamp(filename)
+        if stamp is None:
+            return None
+        pkey = params_key(param)
+        col = "arrays" if arrays else "NULL"
+        with self.lock:
+            row = self.db.execute(
+                f"SELECT summary, {col} FROM metrics WHERE path = ? AND "
+                "params = ? AND size = ? AND mtime = ?",
+                (stamp[0], pkey, stamp[1], stamp[2])).fetchone()
+            if row is None:
+                return None
+            # Written with the next put or in batches, not on every read.
+            self.used[(stamp[0], pkey)] = time.time()
+            if len(self.used) >= USED_EVERY:
+                self.write_used()
+                self.db.commit()
+        return (json.loads(row[0]),
+                unpack_arrays(row[1]) if row[1] is not None else {})
+
+    def summaries(self, filenames: List[str], param: Dict[str, Any]
+                  ) -> Dict[str, Dict[str, Any]]:
+        """Summaries of the files still matching their stored entry."""
+        stamps = {}
+        for f in filenames:
+            stamp = file_stamp(f)
+            if stamp is not None:
+                stamps[stamp[0]] = (f, stamp)
+        if not stamps:
+            return {}
+        pkey = params_key(param)
+        paths = list(stamps)
+        rows = []
+        with self.lock:
+            # By primary key, a few at a time for the SQL variable limit.
+            for i in range(0, len(paths), LOOKUP_BATCH):
+                part = paths[i:i + LOOKUP_BATCH]
+                rows += self.db.execute(
+                    "SELECT path, size, mtime, summary FROM metrics "
+                    "WHERE params = ? AND path IN (%s)" %
+                    ", ".join("?" * len(part)), [pkey] + part).fetchall()
+        ret = {}
+        for path, size, mtime, summary in rows:
+            hit = stamps[path]
+            if hit[1][1:] == (size, mtime):
+                ret[hit[0]] = json.loads(summary)
+        return ret
+
+    def put(self, filename: str, param: Dict[str, Any],
+            summary: Dict[str, Any], arrays: Dict[str, np.ndarray]):
+        stamp = file_stamp(filename)
+        if stamp is None:
+            return
+        blob = pack_arrays(arrays)
+        with self.lock:
+            self.write_used()
+            self.db.execute(
+                "INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (stamp[0], params_key(param), stamp[1], stamp[2],
+                 json.dumps(summary), blob, time.time()))
+            self.db.commit()
+            self.writes += 1
+            if self.writes % VACUUM_EVERY == 0:
+                self.trim()
+
+    def set_max_mb(self, max_mb: int):
+        with self.lock:
+            self.max_bytes = max_mb << 20
+            self.trim()
+
+    def db_size(self) -> int:
+        (pages,) = self.db.execute("PRAGMA page_count").fetchone()
+        (size,) = self.db.execute("PRAGMA page_size").fetchone()
+        return pages * size
+
+    def trim(self):
+        if self.db_size() <= self.max_bytes:
+            return
+        self.write_used()
+        (count, used) = self.db.execute(
+            "SELECT COUNT(*), SUM(LENGTH(summary) + LENGTH(arrays)) "
+            "FROM metrics").fetchone()
+        if count:
+            # Keep the most recently used entries filling 3/4 of the cap.
+            keep = int(count * min(1.0, self.max_bytes * 0.75 / used))
+            self.db.execute(
+                "DELETE FROM metrics WHERE rowid NOT IN (SELECT rowid "
+                "FROM metrics ORDER BY used DESC LIMIT ?)", (keep,))
+            self.db.commit()
+        self.db.execute("VACUUM")
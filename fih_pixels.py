@@ -0,0 +1,114 @@
+import functools
+import cv2
+import numpy as np
+from typing import List, Tuple
+
+LUT_CHUNK = 1 << 20
+
+# BAYERPAT value -> (code to RGBA, code to RGB). The "i" variants swap
+# red and blue.
+BAYER_CONV = {
+    "GRBG": (cv2.COLOR_BAYER_GR2RGBA, cv2.COLOR_BAYER_GR2RGB),
+    "GRBGi": (cv2.COLOR_BAYER_GR2BGRA, cv2.COLOR_BAYER_GR2BGR),
+    "RGGB": (cv2.COLOR_BAYER_RG2RGBA, cv2.COLOR_BAYER_RG2RGB),
+    "RGGBi": (cv2.COLOR_BAYER_RG2BGRA, cv2.COLOR_BAYER_RG2BGR),
+    "BGGR": (cv2.COLOR_BAYER_BG2RGBA, cv2.COLOR_BAYER_BG2RGB),
+    "BGGRi": (cv2.COLOR_BAYER_BG2BGRA, cv2.COLOR_BAYER_BG2BGR),
+    "GBRG": (cv2.COLOR_BAYER_GB2RGBA, cv2.COLOR_BAYER_GB2RGB),
+    "GBRGi": (cv2.COLOR_BAYER_GB2BGRA, cv2.COLOR_BAYER_GB2BGR),
+}
+
+
+@functools.lru_cache(maxsize=16)
+def stretch_lut(bits: int, cmin: float, cmax: float, gamma: float,
+                invert: bool) -> np.ndarray:
+    """Table mapping every 8 or 16 bit value to its uint8 display value.
+
+    Linear stretch between cmin and cmax, optional gamma and inversion,
+    with the same arithmetic as the float path in Image.do_stretch.
+    """
+    v = np.arange(1 << bits, dtype=np.float64)
+    if gamma > 0:
+        v = v ** gamma
+        cmin = cmin ** gamma
+        cmax = cmax ** gamma
+    lut = np.clip((v - cmin) / ((cmax - cmin) / 255.0), 0, 255)
+    lut = lut.astype(np.uint8)
+    if invert:
+        lut = 255 - lut
+    lut.flags.writeable = False
+    return lut
+
+
+def apply_lut(img: np.ndarray, lut: np.ndarray) -> np.ndarray:
+    if lut.size == 256:
+        return cv2.LUT(img, lut)
+    # np.take converts indices to intp, go by rows to bound the temporary.
+    out = np.empty(img.shape, dtype=np.uint8)
+    rows = max(1, LUT_CHUNK // max(1, img[0].size))
+    for r in range(0, img.shape[0], rows):
+        np.take(lut, img[r:r + rows], out=out[r:r + rows])
+    return out
+
+
+@functools.lru_cache(maxsize=None)
+def bayer_layout(code: int) -> Tuple[Tuple[int, ...], ...]:
+    """Cells of the 2x2 Bayer pattern feeding each output channel.
+
+    Cells are numbered row * 2 + col. The layout is read off cv2 itself,
+    so that superpixel_debayer matches cv2.cvtColor(raw, code).
+    """
+    chans: Tuple[List[int], ...] = ([], [], [])
+    for p in range(4):
+        m = np.zeros((8, 8), dtype=np.uint16)
+        m[p // 2::2, p % 2::2] = 1000
+        o = cv2.cvtColor(m, code)[4:6, 4:6, :3].mean(axis=(0, 1))
+        chans[int(o.argmax())].append(p)
+    return tuple(tuple(c) for c in chans)
+
+
+def superpixel_debayer(
+        raw: np.ndarray, code: int, width: int, height: int) -> np.ndarray:
+    """Demosaic a Bayer frame straight to a width x height RGBA image.
+
+    Every 2x2 cell gives one RGB pixel, cells are then area averaged
+    down to the requested size. Channel order is the one of
+    cv2.cvtColor(raw, code), alpha is set to the maximum value.
+    """
+    h = raw.shape[0] // 2 * 2
+    w = raw.shape[1] // 2 * 2
+    planes = [
+        cv2.resize(raw[p // 2:h:2, p % 2:w:2], (width, height),
+                   interpolation=cv2.INTER_AREA)
+        for p in range(4)]
+    out = np.empty((height, width, 4), dtype=raw.dtype)
+    for c, cells in enumerate(bayer_layout(code)):
+        if len(cells) == 1:
+            out[:, :, c] = planes[cells[0]]
+        else:
+            out[:, :, c] = cv2.addWeighted(
+                planes[cells[0]], 0.5, planes[cells[1]], 0.5, 0)
+    out[:, :, 3] = np.iinfo(raw.dtype).max
+    return out
+
+
+def to_gray(raw: np.ndarray, bayer: str = "NONE") -> np.ndarray:
+    """Gray frame as fed to the focuser by Image.make_gray."""
+    if bayer != "NONE":
+        raw = cv2.cvtColor(raw, BAYER_CONV[bayer][0])
+    if raw.ndim == 3:
+        if raw.shape[2] == 4:
+            return cv2.cvtColor(raw, cv2.COLOR_RGBA2GRAY)
+        return cv2.cvtColor(raw, cv2.COLOR_RGB2GRAY)
+    return raw
+
+
+def brightest_star(gray: np.ndarray, fwhm: float) -> Tuple[int, int]:
+    """Position (x, y) of the brightest star-sized spot of a frame.
+
+    The frame is smoothed with a Gaussian of the star FWHM first, so hot
+    pixels and noise count for much less than a star.
+    """
+    sigma = max(fwhm, 1.0) / 2.3548
+    smooth = cv2.GaussianBlur(gray.astype(np.float32), (0, 0), sigma)
+    return cv2.minMaxLoc(smooth)[3]
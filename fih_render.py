@@ -0,0 +1,89 @@
+import threading
+import traceback
+from typing import Callable, Optional
+
+
+class Token:
+    """Cooperative cancellation flag handed to a render job."""
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class RenderWorker:
+    """Single thread rendering one frame at a time.
+
+    Only the most recently submitted job is kept: submitting cancels the
+    job being rendered and replaces the one waiting, which is dropped
+    before it starts. Jobs must poll token.cancelled and return early.
+    A job dropped before it starts calls its dropped callback instead,
+    from the thread dropping it. The token of the last job submitted is
+    cancelled too once the job returned, as what it rendered may still
+    be waiting in the main loop.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending: Optional[Callable[[Token], None]] = None
+        self.pending_token: Optional[Token] = None
+        self.pending_dropped: Optional[Callable[[], None]] = None
+        self.running: Optional[Token] = None
+        self.last: Optional[Token] = None
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, job: Callable[[Token], None],
+               dropped: Optional[Callable[[], None]] = None) -> Token:
+        token = Token()
+        with self.cond:
+            self.cancel_locked()
+            self.pending = job
+            self.pending_token = token
+            self.pending_dropped = dropped
+            self.last = token
+            self.cond.notify()
+        return token
+
+    def cancel(self):
+        with self.cond:
+            self.cancel_locked()
+
+    def cancel_locked(self):
+        if self.last is not None:
+            self.last.cancel()
+        if self.pending_token is not None:
+            self.pending_token.cancel()
+            if self.pending_dropped is not None:
+                self.pending_dropped()
+        self.pending = None
+        self.pending_token = None
+        self.pending_dropped = None
+        if self.running is not None:
+            self.running.cancel()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.pending is None:
+                    self.cond.wait()
+                job = self.pending
+                token = self.pending_token
+                dropped = self.pending_dropped
+                self.pending = None
+                self.pending_token = None
+                self.pending_dropped = None
+                self.running = token
+            try:
+                if not token.cancelled:
+                    job(token)
+                elif dropped is not None:
+                    dropped()
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self.cond:
+                    self.running = None
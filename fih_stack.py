@@ -0,0 +1,140 @@
+from typing import Any, Optional
+import cv2
+import numpy as np
+
+# Window sums of integer frames stay exact in float32 up to this many.
+MAX_WINDOW = 256
+# Largest ring of frames kept in "window" mode.
+MAX_RING_BYTES = 1 << 30
+# Frames in the running variance before pixels are rejected.
+MIN_SAMPLES = 10
+
+CV_DEPTH = {
+    np.uint8: cv2.CV_8U,
+    np.uint16: cv2.CV_16U,
+    np.float32: cv2.CV_32F,
+}
+
+
+class LiveStack:
+    """Running stack of camera frames.
+
+    In "window" mode the stack is the mean of the last frames frames,
+    kept as a float32 sum and a ring of the frames added to it. In
+    "decay" mode it is an exponential moving mean, averaging the first
+    frames frames equally and then forgetting older ones with a time
+    constant of frames frames. A window whose frames would take more
+    than MAX_RING_BYTES is stacked as in "decay" mode.
+
+    With sigma > 0 a running mean and variance of every pixel is kept
+    as in Welford's algorithm, with the weight of new frames bounded as
+    in "decay" mode, and pixels further than sigma standard deviations
+    from that mean, satellites, planes or cosmic rays, are replaced by
+    the mean before stacking. They update the mean and variance as if
+    they were sigma standard deviations away, so that these follow a
+    lasting change within a few frames.
+
+    All the buffers are allocated when the frame size, type or settings
+    change, stacked frames come from pool, a pyasicam BufferPool, and
+    have the type of the input frames.
+    """
+
+    def __init__(self, pool: Any, mode: str = "window", frames: int = 8,
+                 sigma: float = 0.0):
+        self.pool = pool
+        self.shape = ()
+        self.dtype: Optional[np.dtype] = None
+        self.n = 0
+        self.configure(mode, frames, sigma)
+
+    def configure(self, mode: str, frames: int, sigma: float):
+        """Change the settings, restarting the stack if needed."""
+        frames = max(1, min(frames, MAX_WINDOW))
+        # The mean and variance are only kept up to date when rejecting.
+        if self.shape and (mode, frames, sigma > 0) != (
+                self.mode, self.frames, self.sigma > 0):
+            self.restart()
+        self.mode = mode
+        self.frames = frames
+        self.sigma = sigma
+
+    def restart(self):
+        """Forget the frames stacked so far."""
+        self.shape = ()
+
+    def reset(self, im: np.ndarray):
+        self.shape = im.shape
+        self.dtype = im.dtype
+        self.n = 0
+        self.window = (self.mode == "window" and
+                       self.frames * im.nbytes <= MAX_RING_BYTES)
+        if self.sigma > 0 or not self.window:
+            self.mean = np.zeros(im.shape, dtype=np.float32)
+        if self.sigma > 0:
+            self.var = np.zeros(im.shape, dtype=np.float32)
+            self.f = np.empty(im.shape, dtype=np.float32)
+            self.d = np.empty(im.shape, dtype=np.float32)
+            self.sq = np.empty(im.shape, dtype=np.float32)
+            self.mask = np.empty(im.shape, dtype=bool)
+        self.pool.reset(im.nbytes)
+        if self.window:
+            self.sum = np.zeros(im.shape, dtype=np.float32)
+            self.ring = np.zeros((self.frames,) + im.shape, dtype=im.dtype)
+
+    def add(self, im: np.ndarray) -> np.ndarray:
+        """Add a frame, return the stack of the frames so far."""
+        if im.shape != self.shape or im.dtype != self.dtype:
+            self.reset(im)
+        self.n += 1
+        count = min(self.n, self.frames)
+        if self.sigma > 0:
+            im = self.reject(im, 1.0 / count)
+        elif not self.window:
+            cv2.accumulateWeighted(im, self.mean, 1.0 / count)
+        if self.window:
+            slot = self.ring[(self.n - 1) % self.frames]
+            self.sum -= slot
+            np.copyto(slot, im, casting="unsafe")
+            cv2.accumulate(slot, self.sum)
+            return self.output(self.sum, 1.0 / count)
+        return self.output(self.mean, 1.0)
+
+    def reject(self, im: np.ndarray, a: float) -> np.ndarray:
+        """Update the running mean and variance with im, outliers
+        clipped, and return im with the outliers replaced by the mean."""
+        f = self.f
+        d = self.d
+        sq = self.sq
+        np.copyto(f, im)
+        np.subtract(f, self.mean, out=d)
+        if self.n > MIN_SAMPLES:
+            np.multiply(d, d, out=sq)
+            np.multiply(self.var, self.sigma * self.sigma, out=f)
+            # A difference of one unit is never an outlier, or pixels
+            # which have not changed yet could never change.
+            np.maximum(f, 1.0, out=f)
+            np.greater(sq, f, out=self.mask)
+            np.sqrt(f, out=f)
+            np.minimum(d, f, out=d)
+            np.negative(f, out=f)
+            np.maximum(d, f, out=d)
+            np.copyto(f, im)
+            np.copyto(f, self.mean, where=self.mask)
+        # Welford: var = (1 - a) * (var + a * d * d), mean += a * d.
+        np.multiply(d, d, out=sq)
+        sq *= a
+        self.var += sq
+        self.var *= 1.0 - a
+        d *= a
+        self.mean += d
+        if self.dtype.kind in "iu":
+            np.rint(f, out=f)
+        return f
+
+    def output(self, acc: np.ndarray, scale: float) -> np.ndarray:
+        out = self.pool.get()[:acc.size * self.dtype.itemsize].view(
+            self.dtype).reshape(self.shape)
+        # Rounds and saturates to the frame type in one pass.
+        cv2.addWeighted(acc, scale, acc, 0.0, 0.0, dst=out,
+                        dtype=CV_DEPTH[self.dtype.type])
+        return out
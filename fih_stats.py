@@ -0,0 +1,116 @@
+import cv2
+import numpy as np
+from typing import Optional, Sequence, Tuple
+
+# cv2.calcHist counts in float32, which is exact up to 2**24.
+HIST_CHUNK = 1 << 24
+
+
+def strided(data: np.ndarray, max_samples: int) -> np.ndarray:
+    """Regular subsample of data with at most about max_samples pixels."""
+    step = int(np.ceil(np.sqrt(data.size / max_samples))) if max_samples else 1
+    if step <= 1:
+        return data
+    return data[::step, ::step]
+
+
+class Quantiles:
+    """Quantiles of an image computed from its histogram.
+
+    Integer data up to 16 bits is counted exactly (cv2.calcHist over
+    chunks small enough for its float32 counters) and gives the same
+    values as np.percentile. Other data is estimated with
+    np.percentile on a strided subsample of at most max_samples pixels.
+    """
+
+    def __init__(self, data: np.ndarray, max_samples: int = 1 << 20):
+        self.cdf: Optional[np.ndarray] = None
+        self.sample: Optional[np.ndarray] = None
+        if (data.dtype.kind == "u" and data.dtype.itemsize <= 2 and
+                data.ndim == 2):
+            bins = 1 << (8 * data.dtype.itemsize)
+            hist = np.zeros(bins, dtype=np.int64)
+            rows = max(1, HIST_CHUNK // max(1, data.shape[1]))
+            for r in range(0, data.shape[0], rows):
+                chunk = np.ascontiguousarray(data[r:r + rows])
+                hist += cv2.calcHist(
+                    [chunk], [0], None, [bins], [0, bins]).ravel().astype(
+                        np.int64)
+            self.cdf = np.cumsum(hist)
+            self.n = int(self.cdf[-1])
+        else:
+            self.sample = strided(data, max_samples)
+            self.n = self.sample.size
+
+    def value(self, rank: np.ndarray) -> np.ndarray:
+        return np.searchsorted(self.cdf, rank, side="right")
+
+    def percentile(self, want: Sequence[float]) -> np.ndarray:
+        if self.sample is not None:
+            return np.percentile(self.sample, want)
+        # Same linear interpolation between order statistics as
+        # np.percentile.
+        rank = np.asarray(want, dtype=np.float64) / 100.0 * (self.n - 1)
+        lo = np.floor(rank)
+        hi = np.minimum(lo + 1, self.n - 1)
+        vlo = self.value(lo).astype(np.float64)
+        vhi = self.value(hi).astype(np.float64)
+        return vlo + (rank - lo) * (vhi - vlo)
+
+
+def clipped_stats(data: np.ndarray, sigma: float = 3.0, maxiters: int = 5,
+                  max_samples: int = 1 << 20) -> Tuple[float, float, float]:
+    """Fast estimate of astropy's sigma_clipped_stats: mean, median, std.
+
+    Works on a strided subsample of at most max_samples pixels, binned
+    into a histogram (exact bins for 8/16-bit data, 65536 bins between
+    the extremes otherwise). Clipping iterations then only touch the
+    histogram: values further than sigma standard deviations from the
+    median are dropped until nothing changes or maxiters is reached.
+    """
+    sample = strided(data, max_samples)
+    if sample.dtype.kind == "u" and sample.dtype.itemsize <= 2:
+        counts = np.bincount(sample.reshape(-1)).astype(np.float64)
+        values = np.arange(counts.size, dtype=np.float64)
+    else:
+        sample = sample[np.isfinite(sample)]
+        counts, edges = np.histogram(sample, bins=1 << 16)
+        counts = counts.astype(np.float64)
+        values = (edges[:-1] + edges[1:]) / 2.0
+    sel = counts > 0
+    for _ in range(maxiters + 1):
+        (mean, median, std) = _hist_stats(values, counts * sel)
+        new = sel & (np.abs(values - median) <= sigma * std)
+        if (new == sel).all():
+            break
+        sel = new
+    return (mean, median, std)
+
+
+def _hist_stats(values: np.ndarray,
+                counts: np.ndarray) -> Tuple[float, float, float]:
+    n = counts.sum()
+    mean = float((counts * values).sum() / n)
+    std = float(np.sqrt((counts * (values - mean) ** 2).sum() / n))
+    cdf = np.cumsum(counts)
+    lo = values[np.searchsorted(cdf, (n - 1) / 2.0, side="right")]
+    hi = values[np.searchsorted(cdf, n / 2.0, side="right")]
+    return (mean, float((lo + hi) / 2.0), std)
+
+
+def background_mesh(data: np.ndarray, box: int = 256,
+                    sigma: float = 3.0) -> np.ndarray:
+    """Smooth float32 background map from clipped medians of box cells."""
+    ny = max(1, data.shape[0] // box)
+    nx = max(1, data.shape[1] // box)
+    ys = np.linspace(0, data.shape[0], ny + 1).astype(int)
+    xs = np.linspace(0, data.shape[1], nx + 1).astype(int)
+    mesh = np.empty((ny, nx), dtype=np.float32)
+    for i in range(ny):
+        for j in range(nx):
+            cell = data[ys[i]:ys[i + 1], xs[j]:xs[j + 1]]
+            mesh[i, j] = clipped_stats(cell, sigma, max_samples=1 << 14)[1]
+    if ny > 2 and nx > 2:
+        mesh = cv2.medianBlur(mesh, 3)
+    return cv2.resize(mesh, (data.shape[1], data.shape[0]),
+                      interpolation=cv2.INTER_LINEAR)
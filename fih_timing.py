@@ -0,0 +1,125 @@
+import json
+import threading
+import time
+import tracemalloc
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List
+
+
+def out_bytes(out: Any) -> int:
+    """Size of the arrays or surface a stage returned."""
+    if hasattr(out, "nbytes"):
+        return int(out.nbytes)
+    if hasattr(out, "get_stride"):
+        return out.get_stride() * out.get_height()
+    if isinstance(out, (tuple, list)):
+        return sum(out_bytes(o) for o in out)
+    return 0
+
+
+# tracemalloc has one peak for the whole process, so only one stage
+# at a time, in any thread, resets and reads it.
+_peak_lock = threading.Lock()
+
+
+class StageTimer:
+    """Wall time and memory of the stages one frame went through.
+
+    Every stage records the bytes it returned and, when tracemalloc is
+    tracing and no other thread is measuring a peak, the peak of the
+    memory allocated while it ran. Allocations made by other threads
+    meanwhile count too.
+    """
+
+    def __init__(self, label: str):
+        self.label = label
+        self.start = time.time()
+        self.stages: List[Dict[str, Any]] = []
+
+    def call(self, name: str, fn: Callable, *args) -> Any:
+        tracing = (tracemalloc.is_tracing() and
+                   _peak_lock.acquire(blocking=False))
+        try:
+            if tracing:
+                base = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+            t = time.perf_counter()
+            out = fn(*args)
+            seconds = time.perf_counter() - t
+            if tracing:
+                peak = tracemalloc.get_traced_memory()[1] - base
+        finally:
+            if tracing:
+                _peak_lock.release()
+        stage = {"stage": name, "seconds": seconds,
+                 "out_bytes": out_bytes(out)}
+        if tracing:
+            stage["peak_bytes"] = peak
+        self.stages.append(stage)
+        return out
+
+    def total(self) -> float:
+        return sum(s["seconds"] for s in self.stages)
+
+    def summary(self) -> str:
+        parts = ["%s %.0f" % (s["stage"], s["seconds"] * 1000)
+                 for s in self.stages]
+        return "%s = %.0f ms" % (", ".join(parts), self.total() * 1000)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"label": self.label, "time": self.start,
+                "total": self.total(), "stages": self.stages}
+
+
+class Timings:
+    """Rolling history of frame timings.
+
+    With a log file every frame is also appended to it as a JSON line.
+    """
+
+    def __init__(self, history: int = 100, log: str = ""):
+        self.history: Deque[StageTimer] = deque(maxlen=history)
+        self.lock = threading.Lock()
+        self.log = open(log, "a") if log else None
+
+    def add(self, timer: StageTimer):
+        if not timer.stages:
+            return
+        with self.lock:
+            self.history.append(timer)
+            if self.log is not None:
+                self.log.write(json.dumps(timer.as_dict()) + "\n")
+                self.log.flush()
+
+    def averages(self) -> Dict[str, float]:
+        """Mean seconds per stage over the history."""
+        sums: Dict[str, List[float]] = {}
+        with self.lock:
+            for timer in self.history:
+                for s in timer.stages:
+                    sums.setdefault(s["stage"], []).append(s["seconds"])
+        return {k: sum(v) / len(v) for k, v in sums.items()}
+
+    def summary(self) -> str:
+        """Mean stage and frame times over the history."""
+        avg = self.averages()
+        with self.lock:
+            totals = [t.total() for t in self.history]
+        if not totals:
+            return ""
+        parts = ["%s %.0f" % (k, v * 1000) for k, v in avg.items()]
+        return "mean of %d: %s = %.0f ms" % (
+            len(totals), ", ".join(parts), sum(totals) / len(totals) * 1000)
+
+    def dump(self, fname: str):
+        with self.lock:
+            frames = [t.as_dict() for t in self.history]
+        with open(fname, "w") as f:
+            for frame in frames:
+                f.write(json.dumps(frame) + "\n")
+
+    def close(self):
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
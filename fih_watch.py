@@ -0,0 +1,148 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+from typing import Callable, Dict, List, Optional
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import GLib
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_event = struct.Struct("iIII")
+
+
+def _load_libc() -> Optional[ctypes.CDLL]:
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1.restype = ctypes.c_int
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.restype = ctypes.c_int
+        libc.inotify_add_watch.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    except (OSError, AttributeError, TypeError):
+        return None
+    return libc
+
+
+_libc = _load_libc()
+
+
+class DirWatcher:
+    """Report files appearing in or disappearing from a directory.
+
+    added is called with the paths of accepted files once their writer
+    has closed them (or they were moved in), removed with the paths of
+    files deleted or moved out. Both run in the GLib main loop. inotify
+    is used when libc provides it, otherwise the directory is polled
+    every interval seconds and a new file is only reported after its
+    size stopped changing between two polls.
+    """
+
+    def __init__(
+            self, dire: str, accept: Callable[[str], bool],
+            added: Callable[[List[str]], None],
+            removed: Callable[[List[str]], None], interval: int = 1):
+        self.dire = dire
+        self.accept = accept
+        self.added = added
+        self.removed = removed
+        self.fd = -1
+        self.source = None
+        if _libc is not None:
+            self.start_inotify()
+        if self.source is None:
+            self.known = self.scan()
+            self.pending: Dict[str, int] = {}
+            self.dir_mtime = os.stat(self.dire).st_mtime_ns
+            self.source = GLib.timeout_add_seconds(interval, self.poll)
+
+    def start_inotify(self):
+        fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE
+        if _libc.inotify_add_watch(fd, os.fsencode(self.dire), mask) < 0:
+            os.close(fd)
+            return
+        self.fd = fd
+        self.source = GLib.io_add_watch(
+            fd, GLib.PRIORITY_DEFAULT, GLib.IO_IN, self.on_inotify)
+
+    def stop(self):
+        if self.source is not None:
+            GLib.source_remove(self.source)
+            self.source = None
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def on_inotify(self, fd, condition) -> bool:
+        try:
+            buf = os.read(fd, 64 * 1024)
+        except BlockingIOError:
+            return True
+        added = []
+        removed = []
+        off = 0
+        while off + _event.size <= len(buf):
+            _, mask, _, ln = _event.unpack_from(buf, off)
+            off += _event.size
+            name = os.fsdecode(buf[off:off + ln].rstrip(b"\0"))
+            off += ln
+            if not name or not self.accept(name):
+                continue
+            path = os.path.join(self.dire, name)
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                added.append(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                removed.append(path)
+        if removed:
+            self.removed(removed)
+        if added:
+            self.added(added)
+        return True
+
+    def scan(self) -> Dict[str, int]:
+        files = {}
+        with os.scandir(self.dire) as it:
+            for e in it:
+                if self.accept(e.name) and e.is_file():
+                    files[e.path] = e.stat().st_size
+        return files
+
+    def poll(self) -> bool:
+        try:
+            mtime = os.stat(self.dire).st_mtime_ns
+            if mtime == self.dir_mtime and not self.pending:
+                return True
+            self.dir_mtime = mtime
+            files = self.scan()
+        except OSError:
+            return True
+        removed = [f for f in self.known if f not in files]
+        for f in removed:
+            del self.known[f]
+        added = []
+        for f, size in files.items():
+            if f in self.known:
+                continue
+            if self.pending.get(f) == size:
+                del self.pending[f]
+                self.known[f] = size
+                added.append(f)
+            else:
+                self.pending[f] = size
+        for f in list(self.pending):
+            if f not in files:
+                del self.pending[f]
+        if removed:
+            self.removed(removed)
+        if added:
+            self.added(sorted(added))
+        return True
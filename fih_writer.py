@@ -0,0 +1,211 @@
+import datetime
+import os
+import struct
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from astropy.io import fits
+import numpy as np
+
+# .NET ticks (100 ns since 0001-01-01) of the Unix epoch, SER timestamps.
+EPOCH_TICKS = 621355968000000000
+
+SER_COLOR = {
+    "NONE": 0,
+    "RGGB": 8,
+    "GRBG": 9,
+    "GBRG": 10,
+    "BGGR": 11,
+    "BGR": 101,
+}
+
+# FileID, LuID, ColorID, LittleEndian, Width, Height, PixelDepthPerPlane,
+# FrameCount, Observer, Instrument, Telescope, DateTime, DateTime_UTC.
+_ser_header = struct.Struct("<14s7i40s40s40sqq")
+_SER_FRAME_COUNT = 38
+
+
+def ser_ticks(t: float) -> int:
+    return EPOCH_TICKS + int(round(t * 1e7))
+
+
+class QueuedWriter:
+    """Write items from a background thread.
+
+    put() never blocks: items wait in a queue of at most maxlen entries
+    and are dropped, and counted, when it is full. The thread takes up
+    to batch items per wake up and writes them back to back.
+    """
+
+    def __init__(self, maxlen: int = 16, batch: int = 1):
+        self.maxlen = maxlen
+        self.batch = max(1, batch)
+        self.session = time.strftime("%Y%m%d_%H%M%S")
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_error = ""
+        self.queue: Deque[Tuple] = deque()
+        self.cond = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, *item) -> bool:
+        with self.cond:
+            if len(self.queue) >= self.maxlen:
+                self.dropped += 1
+                return False
+            self.queue.append(item)
+            self.cond.notify()
+        return True
+
+    def pending(self) -> int:
+        with self.cond:
+            return len(self.queue)
+
+    def status(self) -> str:
+        msg = "saved %d, queue %d/%d" % (
+            self.written, self.pending(), self.maxlen)
+        if self.dropped:
+            msg += ", %d not saved" % self.dropped
+        if self.errors:
+            msg += ", %d errors (%s)" % (self.errors, self.last_error)
+        return msg
+
+    def close(self):
+        """Write what is queued and stop the thread."""
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and not self.queue:
+                    self.cond.wait()
+                if not self.queue:
+                    break
+                todo: List[Tuple] = []
+                while self.queue and len(todo) < self.batch:
+                    todo.append(self.queue.popleft())
+            for item in todo:
+                # Any failure only loses this item, the thread goes on.
+                try:
+                    self.write(*item)
+                except Exception as e:
+                    self.errors += 1
+                    self.last_error = str(e)
+                else:
+                    self.written += 1
+        try:
+            self.finish()
+        except Exception as e:
+            self.errors += 1
+            self.last_error = str(e)
+
+    def write(self, *item):
+        raise NotImplementedError
+
+    def finish(self):
+        pass
+
+
+def make_dirs(fname: str):
+    dire = os.path.dirname(fname)
+    if dire:
+        os.makedirs(dire, exist_ok=True)
+
+
+class FitsWriter(QueuedWriter):
+    """Write frames as <prefix>_<session>_<sequence>.fit files.
+
+    Items are (prefix, frame, header cards).
+    """
+
+    def __init__(self, maxlen: int = 16, batch: int = 1):
+        self.seq = 0
+        super().__init__(maxlen, batch)
+
+    def write(self, prefix: str, im: np.ndarray, header: Dict[str, Any]):
+        self.seq += 1
+        fname = "%s_%s_%05d.fit" % (prefix, self.session, self.seq)
+        if im.ndim == 3:
+            # RGB24 frames come as BGR pixels, FITS wants RGB planes.
+            im = np.moveaxis(im[:, :, 2::-1], 2, 0)
+        hdu = fits.PrimaryHDU(im)
+        for k, v in header.items():
+            hdu.header[k] = v
+        make_dirs(fname)
+        hdu.writeto(fname)
+
+
+class SerWriter(QueuedWriter):
+    """Append frames to a SER video, <prefix>_<session>.ser.
+
+    Items are (frame, UTC start of exposure). Frames are written as they
+    come, the header is written first with no frames and its frame count
+    patched when closing, after the trailer of per frame timestamps. A
+    frame of a different size or type starts a new file.
+    """
+
+    # Frames written per wake up.
+    BATCH = 8
+
+    def __init__(self, prefix: str, color: str, instrument: str = "",
+                 telescope: str = "", maxlen: int = 64):
+        self.prefix = prefix
+        self.color = color
+        self.instrument = instrument
+        self.telescope = telescope
+        self.files = 0
+        self.f: Optional[Any] = None
+        self.shape: Tuple[int, ...] = ()
+        self.dtype: Optional[np.dtype] = None
+        self.stamps: List[int] = []
+        super().__init__(maxlen, self.BATCH)
+
+    def open(self, im: np.ndarray, t: float):
+        self.files += 1
+        fname = "%s_%s.ser" % (self.prefix, self.session)
+        if self.files > 1:
+            fname = "%s_%s_%d.ser" % (self.prefix, self.session, self.files)
+        make_dirs(fname)
+        self.f = open(fname, "wb", buffering=0)
+        self.shape = im.shape
+        self.dtype = im.dtype
+        self.stamps = []
+        color = "BGR" if im.ndim == 3 else self.color
+        local = t + datetime.datetime.fromtimestamp(t).astimezone(
+            ).utcoffset().total_seconds()
+        # LittleEndian is 0 for little endian data in what capture and
+        # stacking programs actually write and read, whatever the spec.
+        self.f.write(_ser_header.pack(
+            b"LUCAM-RECORDER", 0, SER_COLOR.get(color[:4], 0), 0,
+            im.shape[1], im.shape[0], im.dtype.itemsize * 8, 0,
+            b"", self.instrument.encode()[:40],
+            self.telescope.encode()[:40], ser_ticks(local), ser_ticks(t)))
+
+    def write(self, im: np.ndarray, t: float):
+        if self.f is not None and (
+                im.shape != self.shape or im.dtype != self.dtype):
+            self.finish()
+        if self.f is None:
+            self.open(im, t)
+        if im.dtype.byteorder == ">":
+            im = im.astype(im.dtype.newbyteorder("<"))
+        self.f.write(memoryview(np.ascontiguousarray(im)).cast("B"))
+        self.stamps.append(ser_ticks(t))
+
+    def finish(self):
+        if self.f is None:
+            return
+        f = self.f
+        self.f = None
+        f.write(np.array(self.stamps, dtype="<i8").tobytes())
+        f.seek(_SER_FRAME_COUNT)
+        f.write(struct.pack("<i", len(self.stamps)))
+        f.close()
@@ -17,15 +17,22 @@ limitations under the License.
 
 import json
 import os
+import tracemalloc
 from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
 from optparse import OptionParser
 from fih_image import Image
+from fih_cache import LRUCache, Prefetcher
+from fih_watch import DirWatcher
+from fih_render import RenderWorker, Token
+from fih_metrics import METRIC_PARAMS, MetricsStore
+from fih_timing import Timings
 from fih_cmd import ImagerCmd
 from fih_cam import Cam
 from fih_indi import Indi
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, GLib
+from gi.repository import Gdk, Gtk, GLib
 
 
 class ImagerApp(Gtk.Window):
@@ -43,15 +50,20 @@ class ImagerApp(Gtk.Window):
         parser.add_option(
             "--indi", type="string", default="",
             help="[hostname] or [hostname:port] of the INDI server")
+        parser.add_option("--timing_log", type="string", default="",
+                          help="Append per stage timings to this file")
+        parser.add_option("--trace_alloc", action="store_true",
+                          default=False,
+                          help="Trace peak allocations of every stage")
         (self.options, self.args) = parser.parse_args()
         self.img = None
         self.dire = None
         self.current = None
         self.fit_files = None
         self.do_reload = False
-        self.timer = None
-        self.generation = 0
-        self.file_list_rows = []
+        self.watcher = None
+        self.renderer = RenderWorker()
+        self.fit_sort_key = 0
         self.cam = None
         self.indi = None
         self.param = {
@@ -61,18 +73,48 @@ class ImagerApp(Gtk.Window):
             "display/gamma_stretch": 0,
             "display/force_gray": False,
             "display/lab": False,
+            "display/mmap": True,
+            "display/preview": True,
+            "display/render_cache_mb": 256,
+            "display/render_cache_items": 16,
             "multi/sort_timestamp": False,
+            "multi/prefetch": 2,
+            "multi/cache_mb": 1024,
+            "multi/metrics": True,
+            "multi/metrics_mb": 64,
             "focuser/finder": "dao",
             "focuser/show": "nothing",
             "focuser/n_stars": 100,
             "focuser/text": False,
             "focuser/fwhm": 3.0,
             "focuser/threshold": 3.0,
+            "focuser/tiled": False,
+            "focuser/background": "exact",
+            "timing/show": False,
+            "timing/history": 100,
             "cam/type": "none",
             "cam/id": 0,
             "cam/run": False,
+            "cam/video": False,
+            "cam/queue": 2,
             "cam/save": False,
             "cam/prefix": os.path.join(Path.home(), "Capture"),
+            "cam/save_queue": 16,
+            "cam/save_batch": 1,
+            "cam/record": False,
+            "cam/record_queue": 64,
+            "cam/roi": False,
+            "cam/roi_size": 256,
+            "cam/roi_x": 0,
+            "cam/roi_y": 0,
+            "cam/stack": False,
+            "cam/stack_mode": "window",
+            "cam/stack_frames": 8,
+            "cam/stack_sigma": 0.0,
+            "cam/lucky": False,
+            "cam/lucky_keep": 10.0,
+            "cam/lucky_batch": 100,
+            "cam/lucky_box": 512,
             "cam/expo_us": 100000,
             "cam/gain": 50,
             "cam/brightness": 50,
@@ -85,6 +127,24 @@ class ImagerApp(Gtk.Window):
             "indi/match_telescope": "Telescope Simulator|SynScan",
             "indi/keys": True,
         }
+        self.image_cache = LRUCache(
+            self.param["multi/cache_mb"] << 20, lambda img: img.nbytes())
+        self.prefetcher = Prefetcher(self.image_cache, self.prefetch_load)
+        self.prefetch_param: Dict[str, Any] = {}
+        self.render_cache = LRUCache(
+            self.param["display/render_cache_mb"] << 20,
+            lambda r: r[0].get_stride() * r[0].get_height(),
+            self.param["display/render_cache_items"])
+        if self.options.trace_alloc:
+            tracemalloc.start()
+        self.timings = Timings(
+            self.param["timing/history"], self.options.timing_log)
+        self.metrics: Optional[MetricsStore] = None
+        try:
+            self.metrics = MetricsStore(
+                max_mb=self.param["multi/metrics_mb"])
+        except Exception as e:
+            print("Metrics cache disabled: %s" % e)
 
     def run(self):
         if self.options.image != "":
@@ -118,10 +178,30 @@ class ImagerApp(Gtk.Window):
         self.main.pack_start(self.menu, False, False, 0)
         self.scroll = Gtk.ScrolledWindow()
         self.image = Gtk.Image()
-        self.scroll.add(self.image)
+        self.image_events = Gtk.EventBox()
+        self.image_events.add(self.image)
+        self.image_events.connect("button-press-event", self.image_clicked)
+        self.scroll.add(self.image_events)
         self.paned = Gtk.HPaned()
         self.scroll_list = Gtk.ScrolledWindow()
-        self.file_list = Gtk.ListBox()
+        self.file_store = Gtk.ListStore(str, str)
+        self.file_list = Gtk.TreeView(model=self.file_store)
+        self.file_list.set_headers_visible(False)
+        for n, (title, width) in enumerate(
+                (("File", 200), ("Metrics", 150))):
+            column = Gtk.TreeViewColumn(
+                title, Gtk.CellRendererText(), text=n)
+            column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+            column.set_fixed_width(width)
+            column.set_resizable(True)
+            self.file_list.append_column(column)
+        # Rows are only measured and rendered when visible.
+        self.file_list.set_fixed_height_mode(True)
+        # Open files on a single click, as the ListBox did.
+        self.file_list.set_activate_on_single_click(True)
+        self.file_list.connect(
+            "row-activated",
+            lambda t, path, c: self.show_img(path.get_indices()[0]))
         self.scroll_list.add(self.file_list)
         self.paned.add1(self.scroll_list)
         self.paned.add2(self.scroll)
@@ -132,14 +212,12 @@ class ImagerApp(Gtk.Window):
         self.status_id = self.status.get_context_id("Imager App")
         self.set_status("No Image")
         self.main.pack_end(self.status, False, False, 0)
-        self.connect("delete-event", Gtk.main_quit)
+        self.connect("delete-event", self.quit)
         self.menu.hook_keys()
         self.show_all()
 
     def clear_file_list(self):
-        for row in self.file_list_rows:
-            self.file_list.remove(row)
-        self.file_list_rows = []
+        self.file_store.clear()
 
     def clear_multi(self):
         self.dire = None
@@ -147,6 +225,10 @@ class ImagerApp(Gtk.Window):
         self.fit_files = None
         self.paned.set_position(0)
         self.clear_file_list()
+        self.unwatch()
+        self.prefetcher.want([])
+        self.image_cache.clear()
+        self.render_cache.clear()
 
     def single_image(self, filename: str):
         self.param["target"] = filename
@@ -155,18 +237,13 @@ class ImagerApp(Gtk.Window):
         self.image.clear()
         self.param["mode"] = "single"
         self.img = Image(filename, self)
-        self.img.display(self.param, "new")
+        self.img.display(self.param)
 
     def scroll_list_box(self):
-        row = self.file_list.get_selected_row()
-        if not row:
-            return
-        dx, dy = row.translate_coordinates(self.file_list, 0, 0)
-        adj = self.file_list.get_adjustment()
-        if not adj:
+        if self.current is None:
             return
-        rw, rh = row.get_preferred_height()
-        adj.set_value(dy - (adj.get_page_size() - rh) / 2)
+        self.file_list.scroll_to_cell(
+            Gtk.TreePath(self.current), None, True, 0.5, 0.0)
 
     def show_img(self, what: int):
         if self.fit_files is None:
@@ -192,33 +269,210 @@ class ImagerApp(Gtk.Window):
             what = 0
         if what == self.current and not force:
             return
-        self.file_list.select_row(self.file_list_rows[what])
+        self.file_list.get_selection().select_path(Gtk.TreePath(what))
         self.current = what
-        self.img = Image(self.fit_files[self.current][0], self)
-        self.img.display(self.param, "new")
+        key = self.image_key(self.current)
+        self.img = self.image_cache.get(key)
+        if self.img is None:
+            self.img = Image(self.fit_files[self.current][0], self)
+            self.img.key = key
+        self.img.display(self.param)
+        self.prefetch()
         GLib.idle_add(self.scroll_list_box)
 
+    def image_key(self, idx: int) -> Tuple:
+        f, tstamp = self.fit_files[idx]
+        return (f, tstamp,
+                self.param["display/lab"], self.param["display/mmap"])
+
+    def prefetch(self):
+        self.image_cache.set_budget(self.param["multi/cache_mb"] << 20)
+        self.render_cache.set_budget(
+            self.param["display/render_cache_mb"] << 20,
+            self.param["display/render_cache_items"])
+        self.prefetch_param = dict(
+            self.param, viewport=self.img.viewport(self.param))
+        keys = []
+        for i in range(1, self.param["multi/prefetch"] + 1):
+            for idx in (self.current + i, self.current - i):
+                if 0 <= idx < len(self.fit_files):
+                    keys.append(self.image_key(idx))
+        self.prefetcher.want(keys)
+
+    def prefetch_load(self, key: Tuple) -> Optional[Image]:
+        f, _, lab, mmap = key
+        img = Image(f, self)
+        img.key = key
+        param = dict(self.prefetch_param)
+        param["display/lab"] = lab
+        param["display/mmap"] = mmap
+        if not img.load(param, report=False):
+            return None
+        img.run_stages(param, Token(), last="debayer")
+        return img
+
+    def quit(self, *args):
+        # Quit even when the camera is gone and cannot be stopped.
+        try:
+            try:
+                # Stopping the camera closes the writers, which finish
+                # the FITS and SER files still being written.
+                self.stop_cam()
+            finally:
+                self.renderer.cancel()
+                if self.metrics is not None:
+                    self.metrics.close()
+                    self.metrics = None
+                self.timings.close()
+        finally:
+            Gtk.main_quit()
+
+    def image_loaded(self, img: Image):
+        if img.key is not None:
+            self.image_cache.put(img.key, img)
+
+    def image_rendered(self, img: Image):
+        # The stages add to what the image held when loaded.
+        if img.key is not None:
+            self.image_cache.resize(img.key)
+
+    @staticmethod
+    def is_fit(name: str) -> bool:
+        return os.path.splitext(name)[1].lower() == ".fit"
+
     def add_to_file_list(self, dire: str) -> bool:
         fit_files1 = [os.path.join(dire, f) for f in os.listdir(dire) if (
-            os.path.isfile(os.path.join(dire, f)) and
-            os.path.splitext(f)[1].lower() == ".fit")]
+            os.path.isfile(os.path.join(dire, f)) and self.is_fit(f))]
         fit_files = [(f, os.path.getmtime(f)) for f in fit_files1]
         key = 0
         if self.param["multi/sort_timestamp"]:
             key = 1
-        fit_files.sort(key=lambda x: x[key])
+        fit_files.sort(key=lambda x: (x[key], x[0]))
         if self.fit_files == fit_files:
             return False
-        self.clear_file_list()
-        for f, tstamp in fit_files:
-            row = Gtk.ListBoxRow()
-            b = os.path.basename(f)
-            row.add(Gtk.Label(label=b))
-            self.file_list.add(row)
-            self.file_list_rows.append(row)
-        self.fit_files = fit_files
+        # Another directory shares nothing with the list shown, rebuild.
+        if (self.fit_files is None or self.fit_sort_key != key or
+                dire != self.dire):
+            self.fit_sort_key = key
+            self.current = None
+            self.file_list.set_model(None)
+            self.clear_file_list()
+            summaries = self.cached_metrics([f for f, _ in fit_files])
+            for f, tstamp in fit_files:
+                self.file_store.append([
+                    os.path.basename(f),
+                    self.metrics_text(summaries.get(f))])
+            self.file_list.set_model(self.file_store)
+            self.fit_files = fit_files
+            return True
+        # Both lists are sorted the same way: drop what disappeared, then
+        # what is left is a subsequence of the new list and only the new
+        # entries need to be inserted.
+        new = set(fit_files)
+        for idx in range(len(self.fit_files) - 1, -1, -1):
+            if self.fit_files[idx] not in new:
+                self.delete_row(idx)
+        old = set(self.fit_files)
+        added = [(pos, entry) for pos, entry in enumerate(fit_files)
+                 if entry not in old]
+        summaries = self.cached_metrics([f for _, (f, _) in added])
+        for pos, entry in added:
+            self.insert_row(pos, entry, summaries.get(entry[0]))
         return True
 
+    def insert_row(self, pos: int, entry: Tuple[str, float],
+                   summary: Optional[Dict[str, Any]]):
+        self.fit_files.insert(pos, entry)
+        self.file_store.insert(
+            pos, [os.path.basename(entry[0]), self.metrics_text(summary)])
+        if self.current is not None and pos <= self.current:
+            self.current += 1
+
+    def delete_row(self, idx: int):
+        del self.fit_files[idx]
+        self.file_store.remove(self.file_store.iter_nth_child(None, idx))
+        if self.current is not None:
+            if idx < self.current:
+                self.current -= 1
+            elif idx == self.current:
+                self.current = None
+
+    def metrics_store(self, param: Dict[str, Any]) -> Optional[MetricsStore]:
+        if not param["multi/metrics"]:
+            return None
+        return self.metrics
+
+    def cached_metrics(self, files: List[str]) -> Dict[str, Dict[str, Any]]:
+        store = self.metrics_store(self.param)
+        if store is None:
+            return {}
+        return store.summaries(files, self.param)
+
+    @staticmethod
+    def metrics_text(summary: Optional[Dict[str, Any]]) -> str:
+        if summary is None:
+            return ""
+        text = "%d stars" % summary["stars"]
+        if "hfr" in summary:
+            text += ", HFR %.2f" % summary["hfr"]
+        return text
+
+    def metrics_updated(self, f: str, summary: Dict[str, Any]):
+        if self.fit_files is None:
+            return
+        for idx, entry in enumerate(self.fit_files):
+            if entry[0] == f:
+                self.file_store[idx][1] = self.metrics_text(summary)
+                return
+
+    def refresh_metrics(self):
+        if self.fit_files is None:
+            return
+        summaries = self.cached_metrics([f for f, _ in self.fit_files])
+        for idx, (f, _) in enumerate(self.fit_files):
+            self.file_store[idx][1] = self.metrics_text(summaries.get(f))
+
+    def insert_file(self, f: str, tstamp: float,
+                    summary: Optional[Dict[str, Any]]) -> int:
+        entry = (f, tstamp)
+        key = self.fit_sort_key
+        pos = len(self.fit_files)
+        while pos > 0 and (
+                (self.fit_files[pos - 1][key], self.fit_files[pos - 1][0]) >
+                (entry[key], entry[0])):
+            pos -= 1
+        self.insert_row(pos, entry, summary)
+        return pos
+
+    def delete_file(self, f: str) -> bool:
+        for idx, entry in enumerate(self.fit_files):
+            if entry[0] == f:
+                self.delete_row(idx)
+                return True
+        return False
+
+    def files_added(self, files: List[str]):
+        if self.fit_files is None:
+            return
+        summaries = self.cached_metrics(files)
+        for f in files:
+            try:
+                tstamp = os.path.getmtime(f)
+            except OSError:
+                continue
+            self.delete_file(f)
+            self.insert_file(f, tstamp, summaries.get(f))
+        self.show_img(ImagerCmd.IMG_LAST)
+
+    def files_removed(self, files: List[str]):
+        if self.fit_files is None:
+            return
+        current = self.current
+        for f in files:
+            self.delete_file(f)
+        if current is not None and self.current is None:
+            self.show_img(min(current, len(self.fit_files) - 1))
+
     def multi_image(self, dire: str):
         self.param["target"] = dire
         self.param["mode"] = "multi"
@@ -228,9 +482,6 @@ class ImagerApp(Gtk.Window):
         self.image.clear()
         self.show_all()
         self.write_status("")
-        self.file_list.connect(
-            "row-activated",
-            lambda l, r: self.show_img(r.get_index()))
         self.dire = dire
         pmin, _ = self.file_list.get_preferred_width()
         if not pmin:
@@ -240,6 +491,7 @@ class ImagerApp(Gtk.Window):
         self.paned.connect(
             "notify::position",
             lambda w, u: self.show_img(ImagerCmd.IMG_REDRAW))
+        self.watch()
 
     def multi_reload(self):
         if self.dire is None:
@@ -248,10 +500,12 @@ class ImagerApp(Gtk.Window):
 
     def set_param(self, par: str, val):
         self.param[par] = val
+        if par in METRIC_PARAMS or par == "multi/metrics":
+            self.refresh_metrics()
         if self.img is None:
             return
         if not self.cam:
-            self.img.display(self.param, par)
+            self.img.display(self.param)
 
     def get_param(self, par: str):
         return self.param[par]
@@ -262,17 +516,26 @@ class ImagerApp(Gtk.Window):
     def auto_reload(self, state):
         self.do_reload = state
         if not state:
-            if self.timer is not None:
-                GLib.source_remove(self.timer)
-                self.timer = None
+            self.unwatch()
             return
-        self.timer = GLib.timeout_add_seconds(1, self.timer_tick)
-
-    def timer_tick(self):
-        if self.do_reload is None:
-            return False
+        # Catch up with what was written while not watching.
         self.multi_reload()
-        return True
+        self.watch()
+
+    def watch(self):
+        self.unwatch()
+        if not self.do_reload or self.dire is None:
+            return
+        self.watcher = DirWatcher(
+            self.dire, self.is_fit, self.files_added, self.files_removed)
+
+    def unwatch(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+    def save_timings(self, fname: str):
+        self.timings.dump(fname)
 
     def save_conf(self, fname: str):
         with open(fname, "w") as f:
@@ -288,6 +551,8 @@ class ImagerApp(Gtk.Window):
                 except KeyError:
                     pass
             self.param.update(new_param)
+        if self.metrics is not None:
+            self.metrics.set_max_mb(self.param["multi/metrics_mb"])
         self.menu.update_ui(self.param)
         if self.param["mode"] == "single":
             self.single_image(self.param["target"])
@@ -302,6 +567,17 @@ class ImagerApp(Gtk.Window):
         self.param["mode"] = "cam"
         self.cam = Cam(self)
 
+    def image_clicked(self, w, ev):
+        # A double click on a camera frame focuses on a ROI around it.
+        if ev.type != Gdk.EventType._2BUTTON_PRESS or ev.button != 1:
+            return False
+        if not self.cam or self.cam.image is None:
+            return False
+        pos = self.cam.image.frame_pos(self.param, ev.x, ev.y)
+        if pos is not None:
+            self.cam.focus_on(*pos)
+        return True
+
     def stop_cam(self):
         self.param["cam/run"] = False
         self.menu.update_ui(self.param)
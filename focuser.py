@@ -16,15 +16,122 @@ limitations under the License.
 
 
 from astropy.stats import sigma_clipped_stats
+from astropy.table import Table, vstack
 from photutils import DAOStarFinder, IRAFStarFinder, CircularAperture
+from concurrent.futures import ProcessPoolExecutor
+from fih_stats import clipped_stats, background_mesh
+import multiprocessing
 import numpy as np
 
+HFR_CHUNK = 1024
+TILE_SIZE = 1024
+
+_pool = None
+_pool_workers = 0
+
+
+def make_finder(algo, fwhm, threshold, n_stars):
+    if algo == 'dao':
+        return DAOStarFinder(
+            fwhm=fwhm, threshold=threshold, brightest=n_stars)
+    return IRAFStarFinder(
+        fwhm=fwhm, threshold=threshold, brightest=n_stars,
+        minsep_fwhm=2*fwhm)
+
+
+def find_tile(algo, fwhm, threshold, n_stars, tile, y0, x0, core):
+    """Run the finder on one tile, keep the stars inside its core.
+
+    core is (y0, y1, x0, x1) in frame coordinates: every star belongs to
+    exactly one core, which removes the duplicates found twice in the
+    overlap between tiles.
+    """
+    sources = make_finder(algo, fwhm, threshold, n_stars)(tile)
+    if sources is None:
+        return None
+    sources["xcentroid"] += x0
+    sources["ycentroid"] += y0
+    keep = ((sources["ycentroid"] >= core[0]) &
+            (sources["ycentroid"] < core[1]) &
+            (sources["xcentroid"] >= core[2]) &
+            (sources["xcentroid"] < core[3]))
+    return sources[keep]
+
+
+def get_pool(workers):
+    global _pool, _pool_workers
+    if _pool is None or _pool_workers != workers:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        # Do not fork the GUI process with its threads.
+        _pool = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("spawn"))
+        _pool_workers = workers
+    return _pool
+
+
+def batch_hfr(img, xs, ys, fwhm):
+    """Half flux radius of many stars at once.
+
+    Same quantity as Focuser.star_hfr: the radius enclosing half of the
+    flux within 2 * fwhm. A pixel at distance d from the centroid counts
+    clip(r - d + 0.5, 0, 1) of its value inside radius r, a linear
+    stand-in for the exact pixel/circle overlap, which makes the
+    enclosed flux piecewise linear in r. It is integrated over the
+    sorted breakpoints of all the pixels of a star and the half flux
+    radius is solved for directly instead of bisecting.
+    """
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    out = np.empty(len(xs))
+    for i in range(0, len(xs), HFR_CHUNK):
+        out[i:i + HFR_CHUNK] = _batch_hfr(
+            img, xs[i:i + HFR_CHUNK], ys[i:i + HFR_CHUNK], fwhm)
+    return out
+
+
+def _batch_hfr(img, xs, ys, fwhm):
+    n = len(xs)
+    rmax = 2.0 * fwhm
+    half = int(np.ceil(rmax + 1))
+    off = np.arange(-half, half + 1)
+    rows = np.round(ys).astype(int)[:, None] + off
+    cols = np.round(xs).astype(int)[:, None] + off
+    inside = (
+        ((rows >= 0) & (rows < img.shape[0]))[:, :, None] &
+        ((cols >= 0) & (cols < img.shape[1]))[:, None, :])
+    cut = img[np.clip(rows, 0, img.shape[0] - 1)[:, :, None],
+              np.clip(cols, 0, img.shape[1] - 1)[:, None, :]]
+    cut = np.where(inside, cut, 0).astype(np.float64).reshape(n, -1)
+    dist = np.hypot((rows - ys[:, None])[:, :, None],
+                    (cols - xs[:, None])[:, None, :]).reshape(n, -1)
+    # Each pixel adds its value to the slope of the enclosed flux from
+    # r = d - 0.5 to r = d + 0.5.
+    edges = np.concatenate((dist - 0.5, dist + 0.5), axis=1)
+    deltas = np.concatenate((cut, -cut), axis=1)
+    order = np.argsort(edges, axis=1)
+    edges = np.take_along_axis(edges, order, axis=1)
+    slope = np.cumsum(np.take_along_axis(deltas, order, axis=1), axis=1)
+    flux = np.zeros_like(edges)
+    flux[:, 1:] = np.cumsum(slope[:, :-1] * np.diff(edges, axis=1), axis=1)
+    idx = np.arange(n)
+    k = np.maximum((edges <= rmax).sum(axis=1) - 1, 0)
+    hf = (flux[idx, k] + slope[idx, k] * (rmax - edges[idx, k])) / 2.0
+    k = np.maximum(np.argmax(flux >= hf[:, None], axis=1) - 1, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = edges[idx, k] + (hf - flux[idx, k]) / slope[idx, k]
+    return np.clip(np.nan_to_num(r, nan=0.0), 0.0, rmax)
+
 
 class Focuser:
 
     def __init__(
-            self, fwhm=3.0, threshold_stds=3., algo='iraf', n_stars=100):
+            self, fwhm=3.0, threshold_stds=3., algo='iraf', n_stars=100,
+            fast_hfr=True, workers=0, background='exact'):
         self.sources = None
+        self.fast_hfr = fast_hfr
+        self.workers = workers
+        self.background = background
         self.n = 0
         self.mean = {}
         self.fwhm = fwhm
@@ -37,18 +144,34 @@ class Focuser:
             self.odata = ("sharpness",)
 
     def evaluate(self, data):
-        mean, median, std = sigma_clipped_stats(data, sigma=3.0, maxiters=5)
+        if self.background == 'mesh':
+            # Noise is measured on the residual so that a gradient does
+            # not raise the detection threshold.
+            mesh = background_mesh(data)
+            sub = data - mesh
+            mean, median, std = clipped_stats(sub, sigma=3.0, maxiters=5)
+            median = float(np.median(mesh))
+        else:
+            if self.background == 'exact':
+                mean, median, std = sigma_clipped_stats(
+                    data, sigma=3.0, maxiters=5)
+            else:
+                mean, median, std = clipped_stats(
+                    data, sigma=3.0, maxiters=5)
+            sub = data - median
         self.back = median
         self.back_std = std
-        if self.algo == 'dao':
-            finder = DAOStarFinder(
-                fwhm=self.fwhm, threshold=self.threshold_stds*std,
-                brightest=self.n_stars)
+        threshold = self.threshold_stds*std
+        if self.workers > 1 and max(data.shape) > TILE_SIZE:
+            self.sources = self.find_tiled(sub, threshold)
         else:
-            finder = IRAFStarFinder(
-                fwhm=self.fwhm, threshold=self.threshold_stds*std,
-                brightest=self.n_stars, minsep_fwhm=2*self.fwhm)
-        self.sources = finder(data - median)
+            finder = make_finder(
+                self.algo, self.fwhm, threshold, self.n_stars)
+            self.sources = finder(sub)
+        self.set_means()
+        return self.sources
+
+    def set_means(self):
         if self.sources is None:
             return
         for col in self.sources.colnames:
@@ -56,7 +179,68 @@ class Focuser:
         if self.num() > 0:
             for p in self.odata:
                 self.mean[p] = np.absolute(self.sources.field(p)).mean()
-        return self.sources
+
+    def find_tiled(self, data, threshold):
+        """Detect stars on overlapping tiles in a process pool.
+
+        Each tile keeps its n_stars brightest, which contain the global
+        brightest n_stars picked at the end.
+        """
+        margin = int(np.ceil(4 * self.fwhm)) + 1
+        height, width = data.shape
+        pool = get_pool(self.workers)
+        futures = []
+        for y0 in range(0, height, TILE_SIZE):
+            for x0 in range(0, width, TILE_SIZE):
+                core = (y0, min(y0 + TILE_SIZE, height),
+                        x0, min(x0 + TILE_SIZE, width))
+                ty0 = max(0, y0 - margin)
+                tx0 = max(0, x0 - margin)
+                tile = data[ty0:min(height, core[1] + margin),
+                            tx0:min(width, core[3] + margin)]
+                futures.append(pool.submit(
+                    find_tile, self.algo, self.fwhm, threshold,
+                    self.n_stars, tile, ty0, tx0, core))
+        tables = [t for t in (f.result() for f in futures)
+                  if t is not None and len(t) > 0]
+        if not tables:
+            return None
+        sources = vstack(tables)
+        sources.sort("flux", reverse=True)
+        sources = sources[:self.n_stars]
+        sources["id"] = np.arange(1, len(sources) + 1)
+        return sources
+
+    def summary(self):
+        """Frame statistics, medians over the detected stars."""
+        ret = {"stars": self.num(), "background": float(self.back),
+               "noise": float(self.back_std)}
+        for p in self.odata:
+            if p in self.mean:
+                ret[p] = float(np.median(np.absolute(self.sources[p])))
+        if "hfr" in self.mean:
+            ret["hfr"] = float(np.median(self.hfr))
+        return ret
+
+    def arrays(self):
+        """What restore() needs besides the summary, as plain arrays."""
+        ret = {}
+        if self.sources is not None:
+            ret["sources"] = self.sources.as_array()
+        if "hfr" in self.mean:
+            ret["hfr"] = np.array(self.hfr)
+        return ret
+
+    def restore(self, summary, arrays):
+        self.back = summary["background"]
+        self.back_std = summary["noise"]
+        self.sources = None
+        if "sources" in arrays:
+            self.sources = Table(arrays["sources"])
+        self.set_means()
+        if "hfr" in arrays:
+            self.hfr = list(arrays["hfr"])
+            self.mean["hfr"] = arrays["hfr"].mean()
 
     def draw(self, cr, par, scale=1.0, radius=10, show_text=False):
         if self.sources is None:
@@ -112,7 +296,13 @@ class Focuser:
     def hfr(self, img):
         if self.sources is None:
             return
-        self.hfr = []
-        for i in self.sources:
-            self.hfr.append(self.star_hfr(img, i["xcentroid"], i["ycentroid"]))
+        if self.fast_hfr:
+            self.hfr = list(batch_hfr(
+                img, self.sources["xcentroid"], self.sources["ycentroid"],
+                self.fwhm))
+        else:
+            self.hfr = []
+            for i in self.sources:
+                self.hfr.append(
+                    self.star_hfr(img, i["xcentroid"], i["ycentroid"]))
         self.mean["hfr"] = np.array(self.hfr).mean()
@@ -1,5 +1,6 @@
 import numpy as np
 import os
+import sys
 import ctypes as c
 
 CAMERA_ID_MAX = 128
@@ -267,13 +268,50 @@ class Error(Exception):
         self.code = err
 
 
+class BufferPool:
+    """Ring of uint8 frame buffers of one size, reused across frames.
+
+    A buffer is only handed out again once no array returned from it is
+    alive, so frames kept by the caller are never overwritten. When all
+    of them are in use a new one is allocated, up to count buffers, and
+    past that an unpooled one.
+    """
+
+    def __init__(self, count=3):
+        self.count = count
+        self.size = 0
+        self.bufs = []
+        self.idle = 0
+
+    def refs(self, i):
+        return sys.getrefcount(self.bufs[i])
+
+    def reset(self, size=0):
+        self.size = size
+        self.bufs = []
+
+    def get(self):
+        for i in range(len(self.bufs)):
+            if self.refs(i) <= self.idle:
+                return self.bufs[i]
+        buf = np.empty(self.size, dtype=np.uint8)
+        if len(self.bufs) < self.count:
+            self.bufs.append(buf)
+            del buf
+            # References held by the pool alone, measured the same way.
+            self.idle = self.refs(len(self.bufs) - 1)
+            return self.bufs[-1]
+        return buf
+
+
 class Camera:
 
-    def __init__(self, i):
+    def __init__(self, i, buffers=3):
         self.i = i
         self.width = -1
         self.height = -1
         self.img_type = -1
+        self.pool = BufferPool(buffers)
 
     def GetCameraProperty(self):
         info = CAMERA_INFO()
@@ -331,6 +369,7 @@ class Camera:
         self.width = width
         self.height = height
         self.img_type = img_type
+        self.pool.reset()
 
     def GetROIFormat(self):
         width = c.c_int()
@@ -397,14 +436,29 @@ class Camera:
                 dtype=_im_ds[self.img_type]).reshape(
                     self.height, self.width)
 
-    def bufAlloc(self):
+    def bufAlloc(self, buf=None):
+        """Frame buffer for the current ROI and its length in bytes.
+
+        buf, if given, is a caller owned C-contiguous writable array of
+        at least that many bytes, the frame is written at its start.
+        Otherwise a buffer comes from the pool, which is emptied by
+        SetROIFormat and whenever the frame size changes.
+        """
         if self.img_type == -1:
             self.GetROIFormat()
         t = self.width * self.height * _im_Bpp[self.img_type]
-        return (np.require(np.zeros(t), np.uint8, requires), t)
-
-    def GetVideoData(self, wait):
-        (b, l) = self.bufAlloc()
+        if buf is not None:
+            if (not buf.flags.c_contiguous or not buf.flags.writeable or
+                    buf.nbytes < t):
+                raise ValueError(
+                    "Need a writable C-contiguous buffer of %d bytes" % t)
+            return (buf.reshape(-1).view(np.uint8)[:t], t)
+        if self.pool.size != t:
+            self.pool.reset(t)
+        return (self.pool.get(), t)
+
+    def GetVideoData(self, wait, buf=None):
+        (b, l) = self.bufAlloc(buf)
         err = lib.ASIGetVideoData(self.i, b, l, wait)
         if err != 0:
             raise Error(err)
@@ -437,8 +491,8 @@ class Camera:
             raise Error(err)
         return st.value
 
-    def GetDataAfterExp(self):
-        (b, l) = self.bufAlloc()
+    def GetDataAfterExp(self, buf=None):
+        (b, l) = self.bufAlloc(buf)
         err = lib.ASIGetDataAfterExp(self.i, b, l)
         if err != 0:
             raise Error(err)
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+import fih_stack
+from fih_stack import LiveStack
+
+
+class Pool:
+    """What LiveStack needs of a pyasicam BufferPool."""
+
+    def reset(self, size):
+        self.size = size
+
+    def get(self):
+        return np.empty(self.size, dtype=np.uint8)
+
+
+def noise(rng, level, shape=(100, 100)):
+    return np.rint(rng.normal(level, 10, shape)).astype(np.uint16)
+
+
+@pytest.mark.parametrize("mode", ["window", "decay"])
+def test_noise_is_not_rejected(mode):
+    rng = np.random.default_rng(0)
+    stack = LiveStack(Pool(), mode, 8, 3.0)
+    masked = []
+    for i in range(300):
+        stack.add(noise(rng, 1000))
+        if i >= 20:
+            masked.append(stack.mask.mean())
+    # Well under 5%, and not growing as the variance would decay.
+    assert np.mean(masked) < 0.03
+    assert np.mean(masked[-50:]) < 0.03
+
+
+@pytest.mark.parametrize("mode", ["window", "decay"])
+def test_step_change_is_followed(mode):
+    rng = np.random.default_rng(0)
+    stack = LiveStack(Pool(), mode, 8, 3.0)
+    for _ in range(50):
+        stack.add(noise(rng, 1000))
+    for _ in range(40):
+        out = stack.add(noise(rng, 1200))
+    assert stack.mask.mean() < 0.03
+    assert abs(out.mean() - 1200) < 5
+
+
+def test_outliers_are_rejected():
+    rng = np.random.default_rng(0)
+    stack = LiveStack(Pool(), "window", 8, 3.0)
+    for _ in range(20):
+        stack.add(noise(rng, 1000))
+    im = noise(rng, 1000)
+    im[40:42] = 60000
+    out = stack.add(im)
+    assert stack.mask[40:42].all()
+    assert abs(out[40:42].mean() - 1000) < 5
+
+
+def test_flat_pixels_can_change():
+    stack = LiveStack(Pool(), "decay", 8, 3.0)
+    for _ in range(20):
+        stack.add(np.zeros((10, 10), dtype=np.uint8))
+    for _ in range(40):
+        out = stack.add(np.full((10, 10), 200, dtype=np.uint8))
+    assert not stack.mask.any()
+    assert out.min() > 190
+
+
+def test_large_window_decays(monkeypatch):
+    monkeypatch.setattr(fih_stack, "MAX_RING_BYTES", 8 * 100 * 100 * 2)
+    rng = np.random.default_rng(0)
+    stack = LiveStack(Pool(), "window", 8, 0.0)
+    stack.add(noise(rng, 1000))
+    assert stack.window
+    stack = LiveStack(Pool(), "window", 9, 0.0)
+    for _ in range(20):
+        out = stack.add(noise(rng, 1000))
+    assert not stack.window
+    assert not hasattr(stack, "ring")
+    assert abs(out.mean() - 1000) < 5